@@ -1,224 +1,292 @@
-from datetime import datetime
-from uuid import uuid4
+import time
 from functools import partial
 
-import openai
 from PySide2 import QtWidgets
 from PySide2 import QtCore
 from PySide2 import QtGui
 import qtawesome
 
-from anywhere.widgets import signal_bus, show_message, create_h_spacer_item, create_v_spacer_item
-from anywhere.utils import get_config, chat_history_storage
-from anywhere.markdown_convert import markdown_to_html
+from anywhere.widgets import signal_bus, show_message, create_h_spacer_item
+from anywhere.utils import get_config
+from anywhere.storage import chat_history_storage
+from anywhere.tokens import trim_messages_by_config
+from anywhere.chat.chat_message_view import ChatMessage, ChatMessageModel, ChatMessageDelegate
+from anywhere.chat.render_scheduler import RenderScheduler
+from anywhere.chat.request_executor import ChatRequest, get_request_scheduler
+from anywhere.chat.token_worker import TokenCountWorker
 
 
-class ChatMessageItem(QtWidgets.QFrame):
-    deleted = QtCore.Signal(str)
-    reloaded = QtCore.Signal(str)
+class ChatContentWidget(QtWidgets.QListView):
+    """ 聊天内容列表，只绘制可见的消息 """
 
-    def __init__(self, uid, role, text, success=True, parent=None):
-        super().__init__(parent)
-        self.uid = uid
-        self.role = role
-        self.text = text
-        self.success = success
-
-        self._init_ui()
-
-    def _init_ui(self):
-        self.setObjectName('chat_message_item')
-        self.setStyleSheet('chat_message_item{border: 1px solid red}')
-
-        header_layout = QtWidgets.QHBoxLayout()
-
-        name = '我' if self.role == 'user' else '机器人'
-        info_label = QtWidgets.QLabel('{} {}'.format(name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        header_layout.addWidget(info_label)
-        header_layout.addItem(create_h_spacer_item())
-
-        self.reload_button = QtWidgets.QToolButton()
-        self.reload_button.setMinimumSize(30, 30)
-        self.reload_button.setIcon(qtawesome.icon('mdi6.reload'))
-
-        self.copy_button = QtWidgets.QToolButton()
-        self.copy_button.setMinimumSize(30, 30)
-        self.copy_button.setIcon(qtawesome.icon('ri.file-copy-fill'))
-
-        self.delete_button = QtWidgets.QToolButton()
-        self.delete_button.setMinimumSize(30, 30)
-        self.delete_button.setIcon(qtawesome.icon('mdi6.delete-outline'))
-
-        if self.role != 'user':
-            header_layout.addWidget(self.reload_button)
-        header_layout.addWidget(self.copy_button)
-        header_layout.addWidget(self.delete_button)
-
-        self.message_widget = QtWidgets.QTextEdit()
-        self.message_widget.setFrameShape(QtWidgets.QListWidget.NoFrame)
-        self.message_widget.setReadOnly(True)
-
-        text = markdown_to_html(self.text)
-        self.message_widget.setHtml(text)
-
-        layout = QtWidgets.QVBoxLayout(self)
-        layout.setAlignment(QtCore.Qt.AlignTop)
-        layout.addLayout(header_layout)
-        layout.addWidget(self.message_widget)
-
-        self.document = self.message_widget.document()
-        self.document.contentsChanged.connect(self.message_widget_text_changed)
-
-        self.message_widget_text_changed()
-
-        self.delete_button.clicked.connect(lambda: self.deleted.emit(self.uid))
-        self.copy_button.clicked.connect(
-            lambda: signal_bus.message_copied.emit(self.text))
-        self.reload_button.clicked.connect(lambda: self.reloaded.emit(self.uid))
-
-    def message_widget_text_changed(self):
-        self.document.adjustSize()
-
-        new_height = self.document.size().height()
-        if new_height != self.message_widget.height():
-            self.message_widget.setFixedHeight(new_height)
-            self.setFixedHeight(new_height + 50)
-
-    def set_text(self, text, success=True, final=True):
-        self.text = text
-        if final:
-            text = markdown_to_html(self.text)
-            self.message_widget.setHtml(text)
-        else:
-            self.message_widget.setText(text)
-        self.success = success
+    # 流式输出时最多每隔这么久把暂存的回复写入一次聊天记录
+    flush_interval = 1000
+    # 打开聊天时只加载最近的这么多条消息，滚动到顶部时再加载更早的一页
+    page_size = 50
 
+    # 聊天记录中的消息增加、删除或者回复完成
+    messages_changed = QtCore.Signal()
 
-class ChatContentWidget(QtWidgets.QScrollArea):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.chat_name = None
+        # 第一条已加载的消息在聊天记录中的下标，界面上第 row 条消息的下标为 offset + row
+        self.offset = 0
+        # 滚动条在底部时内容增加后继续停在底部
+        self._stick_to_bottom = True
+        # 加载更早的消息后保持可见内容不动，记录加载前距离底部的距离
+        self._anchor_from_bottom = None
         self._init_ui()
 
     def _init_ui(self):
-        self._widget = QtWidgets.QWidget()
-        self.layout = QtWidgets.QVBoxLayout(self._widget)
-        self.layout.setAlignment(QtCore.Qt.AlignTop)
-        self.layout.addItem(create_v_spacer_item())
+        # 流式输出的增量按帧率合并后再刷新到界面
+        self.render_scheduler = RenderScheduler(
+            self.append_text, get_config('common').get('render_fps', 30), self)
+
+        self.message_model = ChatMessageModel(self)
+        self.delegate = ChatMessageDelegate(self)
+        self.setModel(self.message_model)
+        self.setItemDelegate(self.delegate)
+
+        self.setUniformItemSizes(False)
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.page_size = get_config('common').get('history_page_size', self.page_size)
+        scrollbar = self.verticalScrollBar()
+        scrollbar.setSingleStep(20)
+        scrollbar.valueChanged.connect(self._scroll_value_changed)
+        scrollbar.rangeChanged.connect(self._scroll_range_changed)
+
+        self._flush_timer = QtCore.QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(self.flush_interval)
+        self._flush_timer.timeout.connect(chat_history_storage.flush)
+
+        self.delegate.deleted.connect(self.item_deleted)
+        self.delegate.reloaded.connect(self.item_reloaded)
+        self.delegate.stopped.connect(self.item_stopped)
+        self.delegate.copied.connect(signal_bus.message_copied)
+
+    def schedule_flush(self):
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    @staticmethod
+    def _message_item(message):
+        return ChatMessage(
+            message['role'], message['content'], not message.get('failed'), message['id'])
+
+    def add_message(self, role, message, success=True, uid=None):
+        item = ChatMessage(role, message, success, uid)
+        self.message_model.append_message(item)
+        return item
 
-        self.setWidget(self._widget)
-        self.setWidgetResizable(True)
+    def load_chat(self, chat_name):
+        """ 只加载最近的一页消息 """
+        self.clear()
+        self.chat_name = chat_name
+        count = chat_history_storage.count_messages(chat_name)
+        self.offset = max(count - self.page_size, 0)
+        self._stick_to_bottom = True
+        self.message_model.set_messages(
+            self._message_item(message)
+            for message in chat_history_storage.get_messages_range(
+                chat_name, self.offset, count))
+        self.resume_requests()
+
+    def load_older_messages(self):
+        if not self.offset or not self.chat_name or self._anchor_from_bottom is not None:
+            return
 
-    def add_message(self, role, message, success=True):
-        item = ChatMessageItem(str(uuid4()), role, message, success)
-        item.deleted.connect(self.item_deleted)
-        item.reloaded.connect(self.item_reloaded)
+        start = max(self.offset - self.page_size, 0)
+        messages = chat_history_storage.get_messages_range(
+            self.chat_name, start, self.offset)
+        scrollbar = self.verticalScrollBar()
+        if scrollbar.maximum() > 0:
+            self._anchor_from_bottom = scrollbar.maximum() - scrollbar.value()
+        self.offset = start
+        self.message_model.prepend_messages(
+            self._message_item(message) for message in messages)
+        self.resume_requests()
+
+    def locate_message(self, message_id, position):
+        """ 加载到这条消息所在的位置并滚动过去，position 为消息在聊天记录中的下标 """
+        if not self.chat_name:
+            return
 
-        self.layout.insertWidget(self.layout.count() - 1, item)
-        return item
+        if position < self.offset:
+            messages = chat_history_storage.get_messages_range(
+                self.chat_name, position, self.offset)
+            self.offset = position
+            self.message_model.prepend_messages(
+                self._message_item(message) for message in messages)
+            self.resume_requests()
+
+        index = self.message_model.index_of(message_id)
+        if not index.isValid():
+            return
+        self._stick_to_bottom = False
+        # 等新加载的消息完成布局后再滚动
+        QtCore.QTimer.singleShot(
+            0, lambda: self.scrollTo(index, QtWidgets.QAbstractItemView.PositionAtTop))
+
+    def _scroll_value_changed(self, value):
+        scrollbar = self.verticalScrollBar()
+        self._stick_to_bottom = value >= scrollbar.maximum() - 4
+        if value == scrollbar.minimum() and scrollbar.maximum() > 0:
+            self.load_older_messages()
+
+    def _scroll_range_changed(self, _, max_value):
+        scrollbar = self.verticalScrollBar()
+        if self._anchor_from_bottom is not None:
+            scrollbar.setValue(max_value - self._anchor_from_bottom)
+            self._anchor_from_bottom = None
+        elif self._stick_to_bottom:
+            scrollbar.setValue(max_value)
+
+        if not max_value and self.offset:
+            # 内容不足一屏时无法滚动，直接加载更早的消息
+            QtCore.QTimer.singleShot(0, self.load_older_messages)
+
+    def scroll_to_bottom(self):
+        self._stick_to_bottom = True
+        self.scrollToBottom()
+
+    def resume_requests(self):
+        """ 切换回正在输出的聊天时，把请求重新绑定到新的界面消息上 """
+        for request in get_request_scheduler().active_requests(self.chat_name):
+            item = self.message_model.message(request.message_id)
+            request.item = item
+            if item is not None and not item.busy:
+                item.busy = True
+                item.metrics = request.metrics
+                item.resume_streaming('思考中...')
+                self.message_model.message_changed(item)
+
+    def _requests_for(self, uid):
+        return [
+            request for request in get_request_scheduler().active_requests(self.chat_name)
+            if request.message_id == uid and not request.detached
+        ]
+
+    def _detach_requests(self, uid):
+        """ 消息被删除或重新生成时取消正在为它生成内容的请求 """
+        for request in self._requests_for(uid):
+            request.detached = True
+            get_request_scheduler().cancel(request)
+
+    def append_text(self, item, text):
+        item.append_text(text)
+        self.message_model.message_changed(item)
+        self.delegate.text_changed(item.uid)
+
+    def set_text(self, item, text, success=True):
+        self.render_scheduler.discard(item)
+        item.set_text(text, success)
+        self.message_model.message_changed(item)
+        self.delegate.text_changed(item.uid)
 
     def item_reloaded(self, uid):
-        for index in range(self.layout.count()):
-            widget = self.layout.itemAt(index).widget()
-            if widget and widget.uid == uid:
-                widget.set_text('重新生成中...')
-
-                messages = chat_history_storage.get_message_by_index(
-                    self.chat_name, index)
-                config = chat_history_storage.get_common_config(self.chat_name)
-                send_message_thread = SendMessageThread(
-                    messages,
-                    get_config('common'),
-                    config.get('temperature', 0.6),
-                    self
-                )
-                send_message_thread.show_message_signal.connect(
-                    partial(self._show_message, widget, index))
-                send_message_thread.start()
-                break
-
-    def _show_message(self, widget, index, data):
-        if data['success']:
-            chat_history_storage.replace_message_by_index(
-                self.chat_name, data['message'], index)
+        item = self.message_model.message(uid)
+        if item is None:
+            return
+        if chat_history_storage.get_message_by_id(self.chat_name, uid) is None:
+            return show_message('聊天记录中没有这条消息，无法重新生成', 'error')
+
+        self._detach_requests(uid)
+        self.set_text(item, '重新生成中...')
+
+        messages = chat_history_storage.get_messages_before(self.chat_name, uid)
+        chat_history_storage.replace_message_by_id(self.chat_name, uid, '', final=False)
+        config = chat_history_storage.get_common_config(self.chat_name)
+        self.start_request(item, messages, get_config('common'),
+                           config.get('temperature', 0.6))
+
+    def start_request(self, item, messages, config, temperature):
+        # 出错的回复不作为上下文，按上下文策略裁剪，只发送 role 和 content
+        messages = [
+            {'role': message['role'], 'content': message['content']}
+            for message in trim_messages_by_config(
+                [m for m in messages if not m.get('failed')], config)
+        ]
+        request = ChatRequest(self.chat_name, item.uid, messages, config, temperature)
+        request.item = item
+        item.busy = True
+        item.metrics = request.metrics
+        request.show_message_signal.connect(partial(self._show_message, request))
+        get_request_scheduler().submit(request)
+        return request
+
+    def _show_message(self, request, data):
+        chat_name = request.chat_name
+        if request.detached or chat_name not in chat_history_storage.get_histories():
+            return
+
+        start = time.perf_counter()
+        if not data['success']:
+            # 保留出错的消息，界面上的错误提示与聊天记录一致，之后可以重新生成
+            chat_history_storage.mark_message_failed(
+                chat_name, request.message_id, data['message'])
+        elif data['final']:
+            chat_history_storage.replace_message_by_id(
+                chat_name, request.message_id, data['message'])
+        else:
+            chat_history_storage.append_message_content_by_id(
+                chat_name, request.message_id, data['delta'])
+            self.schedule_flush()
+        request.metrics.add_persist(time.perf_counter() - start)
+
+        # 只有界面上显示的正是发起请求的聊天时才刷新
+        if chat_name != self.chat_name or request.item is None:
+            return
+        if data['final']:
+            self.messages_changed.emit()
+            request.item.busy = False
+            request.item.metrics = None
+            text = data['message']
+            if data.get('cancelled') and not text:
+                text = '已停止生成'
+            start = time.perf_counter()
+            self.set_text(request.item, text, data['success'])
+            request.metrics.add_ui_apply(time.perf_counter() - start)
         else:
-            chat_history_storage.pop_message(self.chat_name)
+            self.render_scheduler.append(request.item, data['delta'])
 
-        widget.set_text(data['message'], data['success'], data['final'])
+    def item_stopped(self, uid):
+        for request in self._requests_for(uid):
+            get_request_scheduler().cancel(request)
 
     def item_deleted(self, uid):
-        for index in range(self.layout.count()):
-            widget = self.layout.itemAt(index).widget()
+        item = self.message_model.remove_message(uid)
+        if item is None:
+            return
 
-            if widget and widget.uid == uid:
-                widget.deleteLater()
-                chat_history_storage.delete_message_by_index(self.chat_name, index)
-                break
+        self._detach_requests(uid)
+        self.render_scheduler.discard(item)
+        self.delegate.forget(uid)
+        chat_history_storage.delete_message_by_id(self.chat_name, uid)
+        self.messages_changed.emit()
 
     def clear(self):
-        for index in range(self.layout.count()):
-            widget = self.layout.itemAt(index).widget()
-
-            if widget:
-                widget.deleteLater()
+        self.render_scheduler.clear()
+        self.delegate.clear()
+        self.message_model.clear()
+        self.offset = 0
+        self._anchor_from_bottom = None
 
     def set_chat_name(self, name):
         self.chat_name = name
 
 
-class SendMessageThread(QtCore.QThread):
-    show_message_signal = QtCore.Signal(dict)
-
-    def __init__(self, messages, config, temperature, parent=None):
-        super().__init__(parent)
-        self.messages = messages
-        self.config = config
-        self.temperature = temperature
-
-    def run(self):
-        url = self.config.get('proxy', 'https://api.openai.com/v1')
-        key = self.config['key']
-        model = self.config['model']
-
-        openai.api_key = key
-        openai.api_base = url
-        print(self.messages)
-        try:
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=self.messages,
-                temperature=self.temperature,
-                stream=True
-            )
-            message = ''
-            for chunk in response:
-                chunk_message = chunk['choices'][0]['delta']
-                if "content" in chunk_message:
-                    message_text = chunk_message['content']
-                    message += message_text
-                    self.show_message_signal.emit({
-                        'success': True,
-                        'message': message,
-                        'final': False
-                    })
-            self.show_message_signal.emit({
-                'success': True,
-                'message': message,
-                'final': True
-            })
-        except Exception as e:
-            self.show_message_signal.emit({
-                'success': False,
-                'message': f'请求出错：\n{str(e)}',
-                'final': True
-            })
-
-
 class ChatWidget(QtWidgets.QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self._history_messages = []
         self._history_data = {}
+        self.token_worker = TokenCountWorker(self)
+        self.token_worker.counted.connect(self._token_counted)
 
         self._init_ui()
 
@@ -227,13 +295,12 @@ class ChatWidget(QtWidgets.QWidget):
         header_layout.setContentsMargins(10, 0, 10, 0)
 
         self.role_label = QtWidgets.QLabel('角色名：{}'.format('通用'))
-        self.token_label = QtWidgets.QLabel('534')
+        self.token_label = QtWidgets.QLabel('0')
         header_layout.addWidget(self.role_label)
 
         header_layout.addItem(create_h_spacer_item())
-        # 暂时不显示 token
-        # header_layout.addWidget(QtWidgets.QLabel('token: '))
-        # header_layout.addWidget(self.token_label)
+        header_layout.addWidget(QtWidgets.QLabel('token: '))
+        header_layout.addWidget(self.token_label)
 
         self.content_widget = ChatContentWidget()
         self.content_scrollbar = self.content_widget.verticalScrollBar()
@@ -262,26 +329,28 @@ class ChatWidget(QtWidgets.QWidget):
         self.send_button.clicked.connect(self.send_message)
         send_text_shortcut.activated.connect(self.send_message)
         signal_bus.history_item_changed.connect(self.history_item_changed)
-        self.content_scrollbar.rangeChanged.connect(
-            lambda _, max_v: self.content_scrollbar.setValue(max_v))
+        signal_bus.history_renamed.connect(self.history_renamed)
+        signal_bus.message_located.connect(self.message_located)
+        self.content_widget.messages_changed.connect(self.update_token_count)
 
     def history_item_changed(self, data):
         self._history_data = data
         self.role_label.setText(f'角色名：{data["data"]["role"] or "通用"}')
-        self.content_widget.set_chat_name(data['name'])
-        self.content_widget.clear()
+        self.content_widget.load_chat(data['name'])
+        self.update_token_count()
 
-        _messages = chat_history_storage.get_messages(data['name'])
-        if not _messages:
+    def history_renamed(self, old_name, chat_name):
+        """ 正在显示的聊天改名后，之后的输出和发送都使用新名字 """
+        if self._history_data.get('name') != old_name:
             return
+        self._history_data = {
+            'name': chat_name, 'data': chat_history_storage.get_common_config(chat_name)}
+        self.role_label.setText(f'角色名：{self._history_data["data"].get("role") or "通用"}')
+        self.content_widget.set_chat_name(chat_name)
 
-        messages = _messages
-        if _messages[0]['role'] == 'system':
-            messages = _messages[1:]
-
-        self.content_widget.clear()
-        for message in messages:
-            self.content_widget.add_message(message['role'], message['content'])
+    def message_located(self, data):
+        if data['chat_name'] == self._history_data.get('name'):
+            self.content_widget.locate_message(data['message_id'], data['position'])
 
     def send_message(self):
         texts = self.send_text_widget.toPlainText().strip()
@@ -293,30 +362,42 @@ class ChatWidget(QtWidgets.QWidget):
         if not key:
             return show_message('请先在公共设置中设置 API Key')
 
-        chat_history_storage.append_messages(
-            self._history_data['name'], {'role': 'user', 'content': texts})
-        self.content_widget.add_message('user', texts)
+        chat_name = self._history_data['name']
+        message_id = chat_history_storage.append_messages(
+            chat_name, {'role': 'user', 'content': texts})
+        self.content_widget.add_message('user', texts, uid=message_id)
+        self.content_widget.scroll_to_bottom()
         self.send_text_widget.setPlainText('')
+        self.update_token_count()
 
-        # 设置默认的
-        item = self.content_widget.add_message('bot', '思考中...', True)
-        chat_history_storage.append_messages(self._history_data['name'], '思考中...')
+        messages = list(chat_history_storage.get_messages(chat_name))
 
-        send_message_thread = SendMessageThread(
-            chat_history_storage.get_messages(self._history_data['name']),
+        # 设置默认的，收到第一段回复后替换
+        message_id = chat_history_storage.append_messages(
+            chat_name, {'role': 'assistant', 'content': ''})
+        item = self.content_widget.add_message('bot', '思考中...', True, message_id)
+
+        self.content_widget.start_request(
+            item,
+            messages,
             config,
-            self._history_data['data']['temperature'],
-            self
+            self._history_data['data']['temperature']
         )
-        send_message_thread.show_message_signal.connect(partial(self.show_message, item))
-        send_message_thread.start()
 
-    def show_message(self, item, data):
-        if data['success']:
-            chat_history_storage.replace_message_by_index(
-                self._history_data['name'], data['message'])
-        else:
-            chat_history_storage.pop_message(self._history_data['name'])
+    def update_token_count(self):
+        """ 显示当前聊天的 token 数，按上下文策略裁剪后会少于全部消息时显示为 发送/全部 """
+        if not self._history_data:
+            return
 
-        item.set_text(data['message'], data['success'], data['final'])
-        item.update()
+        # 切换聊天时不在界面线程加载和统计整个聊天
+        self.token_worker.count(
+            chat_history_storage.messages_reader(self._history_data['name']),
+            get_config('common'))
+
+    def _token_counted(self, serial, sent, total):
+        if serial != self.token_worker.serial:
+            return
+        if sent < total:
+            self.token_label.setText('{}/{}'.format(sent, total))
+        else:
+            self.token_label.setText(str(total))
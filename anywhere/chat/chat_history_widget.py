@@ -3,8 +3,11 @@ from PySide2 import QtCore
 from PySide2 import QtGui
 import qtawesome
 
-from anywhere.utils import chat_history_storage, get_config
+from anywhere.utils import get_config
+from anywhere.storage import chat_history_storage
 from anywhere.widgets import show_message, show_question, signal_bus
+from anywhere.chat.request_executor import get_request_scheduler
+from anywhere.search import get_search_index
 
 
 class NewChatWindow(QtWidgets.QWidget):
@@ -84,7 +87,8 @@ class NewChatWindow(QtWidgets.QWidget):
         if not name:
             return show_message('请设置名称', 'error')
 
-        if not self.old_name and name in chat_history_storage.get_history_names():
+        # 新建和改名都不能与已有的聊天重名
+        if name != self.old_name and name in chat_history_storage.get_history_names():
             return show_message('名字已存在', 'error')
 
         self.saved.emit({
@@ -138,22 +142,43 @@ class HistoryItem(QtWidgets.QWidget):
 
 
 class ChatHistoryWidget(QtWidgets.QWidget):
+    # 输入停顿这么久（毫秒）后再搜索
+    search_delay = 300
+
+    # 搜索索引在后台线程建立完成，通过信号转回界面线程
+    search_index_built = QtCore.Signal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        # 创建时开始监听聊天记录的修改，搜索索引随之更新
+        self.search_index = get_search_index()
         self._init_ui()
 
     def _init_ui(self):
         self.new_chat_window = NewChatWindow()
 
         self.add_button = QtWidgets.QPushButton("新建", minimumHeight=30)
+        self.search_line = QtWidgets.QLineEdit(placeholderText='搜索聊天记录', minimumHeight=30)
+        self.search_line.setClearButtonEnabled(True)
         self.history_list_widget = QtWidgets.QListWidget()
         self.history_list_widget.setFrameShape(QtWidgets.QListWidget.NoFrame)
+        self.search_result_widget = QtWidgets.QListWidget()
+        self.search_result_widget.setFrameShape(QtWidgets.QListWidget.NoFrame)
+        self.search_result_widget.setWordWrap(True)
+        self.search_result_widget.hide()
+
+        self._search_timer = QtCore.QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(self.search_delay)
+        self._search_timer.timeout.connect(self.search)
 
         layout = QtWidgets.QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
         layout.setSpacing(4)
         layout.addWidget(self.add_button)
+        layout.addWidget(self.search_line)
         layout.addWidget(self.history_list_widget)
+        layout.addWidget(self.search_result_widget)
 
         self.add_button.clicked.connect(
             lambda: self.new_chat_window.show_window(
@@ -161,18 +186,72 @@ class ChatHistoryWidget(QtWidgets.QWidget):
         )
         self.new_chat_window.saved.connect(self.new_chat_window_saved)
         self.history_list_widget.currentRowChanged.connect(self.history_list_row_changed)
+        self.search_line.textChanged.connect(lambda: self._search_timer.start())
+        self.search_line.returnPressed.connect(self.search)
+        self.search_result_widget.itemClicked.connect(self.search_result_clicked)
+        self.search_index_built.connect(self._search_index_built)
 
     def history_list_row_changed(self, row):
         name = self.history_list_widget.item(row).name
         data = chat_history_storage.get_common_config(name)
         signal_bus.history_item_changed.emit({'name': name, 'data': data})
 
+    def search(self):
+        self._search_timer.stop()
+        text = self.search_line.text().strip()
+        self.history_list_widget.setVisible(not text)
+        self.search_result_widget.setVisible(bool(text))
+        self.search_result_widget.clear()
+        if not text:
+            return
+
+        if not self.search_index.built:
+            # 第一次搜索时在后台读取所有聊天记录建立索引，建好后再搜索
+            self.search_index.start_rebuild(self.search_index_built.emit)
+            self._add_search_hint('正在建立搜索索引…')
+            return
+
+        hits = self.search_index.search(text)
+        for hit in hits:
+            role = '用户' if hit['role'] == 'user' else '助手'
+            item = QtWidgets.QListWidgetItem(
+                f'{hit["chat_name"]} · {role}\n{hit["snippet"]}')
+            item.hit = hit
+            self.search_result_widget.addItem(item)
+
+        if not hits:
+            self._add_search_hint('没有找到相关的消息')
+
+    def _add_search_hint(self, text):
+        item = QtWidgets.QListWidgetItem(text)
+        item.setFlags(QtCore.Qt.NoItemFlags)
+        self.search_result_widget.addItem(item)
+
+    def _search_index_built(self):
+        if self.search_index.built:
+            self.search()
+        elif self.search_line.text().strip():
+            self.search_result_widget.clear()
+            self._add_search_hint('建立搜索索引失败，请重新搜索')
+
+    def search_result_clicked(self, item):
+        hit = getattr(item, 'hit', None)
+        if hit is None:
+            return
+
+        for index in range(self.history_list_widget.count()):
+            if self.history_list_widget.item(index).name == hit['chat_name']:
+                self.history_list_widget.setCurrentRow(index)
+                signal_bus.message_located.emit(hit)
+                break
+
     def init_data(self):
-        histories = chat_history_storage.get_histories()
-        if not histories:
+        # 只读取聊天列表，消息内容在选中聊天时才加载
+        index = chat_history_storage.get_history_index()
+        if not index:
             return
 
-        for name, data in histories.items():
+        for name, data in index.items():
             self.add_item(name, data['common'])
 
         self.history_list_widget.setCurrentRow(0)
@@ -202,6 +281,8 @@ class ChatHistoryWidget(QtWidgets.QWidget):
                         widget = self.history_list_widget.itemWidget(item)
                         widget.set_name(name)
                         chat_history_storage.change_common_config_name(old_name, name, data)
+                        get_request_scheduler().rename_chat(old_name, name)
+                        signal_bus.history_renamed.emit(old_name, name)
 
                     chat_history_storage.set_system_message(name, prompt)
                     break
@@ -227,5 +308,6 @@ class ChatHistoryWidget(QtWidgets.QWidget):
             item = self.history_list_widget.item(index)
             if item.name == name:
                 self.history_list_widget.takeItem(index)
+                get_request_scheduler().cancel_chat(name)
                 chat_history_storage.delete_history(name)
                 break
@@ -0,0 +1,382 @@
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime
+from uuid import uuid4
+
+from PySide2 import QtWidgets
+from PySide2 import QtCore
+from PySide2 import QtGui
+import qtawesome
+
+from anywhere.markdown_convert import apply_code_style, IncrementalMarkdownRenderer
+from anywhere.chat.markdown_worker import MarkdownRenderWorker
+
+MESSAGE_ROLE = QtCore.Qt.UserRole + 1
+
+
+class ChatMessage(object):
+    """ 一条聊天消息在界面中的数据，uid 与聊天记录中消息的 id 相同，流式输出时增量保存在 chunks 中 """
+
+    def __init__(self, role, text, success=True, uid=None):
+        self.uid = uid or str(uuid4())
+        self.role = role
+        self.text = text
+        self.success = success
+        self.created_at = datetime.now()
+        self.chunks = []
+        self.streaming = False
+        # 是否有请求正在为这条消息生成内容
+        self.busy = False
+        # 正在生成这条消息的请求的统计，界面应用增量的耗时记录在这里
+        self.metrics = None
+
+    def current_text(self):
+        if self.streaming:
+            return ''.join(self.chunks)
+        return self.text
+
+    def append_text(self, text):
+        if not self.streaming:
+            self.streaming = True
+            self.chunks = []
+        self.chunks.append(text)
+
+    def resume_streaming(self, placeholder):
+        """ 重新绑定到仍在输出的请求，已经收到的内容作为第一段增量 """
+        if self.text:
+            self.streaming = True
+            self.chunks = [self.text]
+        else:
+            self.text = placeholder
+
+    def set_text(self, text, success=True):
+        self.text = text
+        self.success = success
+        self.streaming = False
+        self.chunks = []
+
+
+class ChatMessageModel(QtCore.QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._messages = []
+        # {uid: row}，行号变化后在查询时自动重建
+        self._rows = {}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._messages)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        message = self._messages[index.row()]
+        if role == MESSAGE_ROLE:
+            return message
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            return message.current_text()
+        return None
+
+    def row_of(self, uid):
+        row = self._rows.get(uid)
+        if row is None or row >= len(self._messages) or self._messages[row].uid != uid:
+            self._rows = {message.uid: row for row, message in enumerate(self._messages)}
+            row = self._rows.get(uid)
+        return -1 if row is None else row
+
+    def message_at(self, row):
+        if 0 <= row < len(self._messages):
+            return self._messages[row]
+        return None
+
+    def message(self, uid):
+        row = self.row_of(uid)
+        return self._messages[row] if row >= 0 else None
+
+    def index_of(self, uid):
+        row = self.row_of(uid)
+        return self.index(row) if row >= 0 else QtCore.QModelIndex()
+
+    def append_message(self, message):
+        row = len(self._messages)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self._messages.append(message)
+        self._rows[message.uid] = row
+        self.endInsertRows()
+
+    def prepend_messages(self, messages):
+        messages = list(messages)
+        if not messages:
+            return
+
+        self.beginInsertRows(QtCore.QModelIndex(), 0, len(messages) - 1)
+        self._messages[:0] = messages
+        self.endInsertRows()
+
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self._messages = list(messages)
+        self.endResetModel()
+
+    def remove_message(self, uid):
+        row = self.row_of(uid)
+        if row < 0:
+            return None
+
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        message = self._messages.pop(row)
+        self.endRemoveRows()
+        return message
+
+    def message_changed(self, message):
+        index = self.index_of(message.uid)
+        if index.isValid():
+            self.dataChanged.emit(index, index)
+
+    def clear(self):
+        self.set_messages([])
+
+
+class _DocumentEntry(object):
+    def __init__(self, document):
+        self.document = document
+        # None 表示还没有写入内容
+        self.streaming = None
+        self.text = None
+        # 流式输出时已写入文档的增量个数、增量渲染器和稳定部分的结束位置
+        self.applied = 0
+        self.renderer = None
+        self.stable_pos = 0
+
+    def reset_streaming(self):
+        self.document.clear()
+        apply_code_style(self.document)
+        self.streaming = True
+        self.text = None
+        self.applied = 0
+        self.renderer = IncrementalMarkdownRenderer()
+        self.stable_pos = 0
+
+
+class ChatMessageDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    绘制聊天消息，只为正在显示的消息创建 QTextDocument。
+
+    没有测量过的消息先按字数估算高度，真正绘制时再用文档的实际高度修正。
+    Markdown 在后台线程渲染，渲染完成前先显示纯文本；流式输出时按块增量渲染。
+    """
+
+    copied = QtCore.Signal(str)
+    deleted = QtCore.Signal(str)
+    reloaded = QtCore.Signal(str)
+    stopped = QtCore.Signal(str)
+
+    margin = 8
+    header_height = 30
+    button_size = 26
+    max_documents = 64
+
+    def __init__(self, view):
+        super().__init__(view)
+        self._view = view
+        # {uid: _DocumentEntry}
+        self._documents = OrderedDict()
+        self._render_worker = MarkdownRenderWorker(parent=self)
+        self._render_worker.rendered.connect(self._markdown_rendered)
+        # {uid: (width, height)}
+        self._heights = {}
+        self._icons = {
+            'reload': qtawesome.icon('mdi6.reload'),
+            'copy': qtawesome.icon('ri.file-copy-fill'),
+            'delete': qtawesome.icon('mdi6.delete-outline'),
+            'stop': qtawesome.icon('mdi6.stop-circle-outline'),
+        }
+
+    def _text_width(self):
+        return max(self._view.viewport().width() - self.margin * 4, 50)
+
+    def _document(self, message, width):
+        entry = self._documents.get(message.uid)
+        if entry is None:
+            document = QtGui.QTextDocument(self)
+            document.setDefaultFont(self._view.font())
+            apply_code_style(document)
+            entry = self._documents[message.uid] = _DocumentEntry(document)
+
+        if message.streaming:
+            if entry.streaming is not True:
+                entry.reset_streaming()
+            if entry.applied < len(message.chunks):
+                start = time.perf_counter()
+                self._append_streaming(entry, ''.join(message.chunks[entry.applied:]))
+                entry.applied = len(message.chunks)
+                if message.metrics is not None:
+                    message.metrics.add_ui_apply(time.perf_counter() - start)
+        elif entry.streaming is not False or entry.text != message.text:
+            was_streaming = entry.streaming is True
+            entry.streaming = False
+            entry.renderer = None
+            entry.text = message.text
+
+            html = self._render_worker.render(message.uid, message.text)
+            if html is not None:
+                entry.document.setHtml(html)
+            elif not was_streaming:
+                entry.document.setPlainText(message.text)
+            # 刚结束流式输出时保留增量渲染的内容，等完整渲染完成后再替换，避免跳动
+
+        self._documents.move_to_end(message.uid)
+        while len(self._documents) > self.max_documents:
+            _, evicted = self._documents.popitem(last=False)
+            evicted.document.deleteLater()
+
+        document = entry.document
+        if document.textWidth() != width:
+            document.setTextWidth(width)
+        return document
+
+    def _append_streaming(self, entry, text):
+        """ 新完成的块追加到稳定部分之后，只替换末尾未完成的块 """
+        blocks = entry.renderer.feed(text)
+
+        cursor = QtGui.QTextCursor(entry.document)
+        cursor.setPosition(entry.stable_pos)
+        cursor.movePosition(QtGui.QTextCursor.End, QtGui.QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        for html in blocks:
+            self._insert_html(cursor, html)
+        entry.stable_pos = cursor.position()
+        self._insert_html(cursor, entry.renderer.tail_html())
+
+    @staticmethod
+    def _insert_html(cursor, html):
+        if not html:
+            return
+        if cursor.position() > 0:
+            cursor.insertBlock(QtGui.QTextBlockFormat(), QtGui.QTextCharFormat())
+        cursor.insertHtml(html)
+
+    @staticmethod
+    def _estimate_height(message, width, font_metrics):
+        chars_per_line = max(width // max(font_metrics.averageCharWidth(), 1), 1)
+        lines = sum(
+            max(1, math.ceil(len(line) / chars_per_line))
+            for line in message.current_text().split('\n')
+        )
+        return lines * font_metrics.lineSpacing() + 8
+
+    def _button_rects(self, rect, message):
+        actions = ['copy', 'delete']
+        if message.busy:
+            actions.insert(0, 'stop')
+        elif message.role != 'user':
+            actions.insert(0, 'reload')
+
+        right = rect.right() - self.margin
+        top = rect.top() + self.margin + (self.header_height - self.button_size) // 2
+        rects = []
+        for action in reversed(actions):
+            left = right - self.button_size
+            rects.insert(0, (action, QtCore.QRect(left, top, self.button_size, self.button_size)))
+            right = left - 4
+        return rects
+
+    def sizeHint(self, option, index):
+        message = index.data(MESSAGE_ROLE)
+        width = self._text_width()
+
+        cached = self._heights.get(message.uid)
+        if cached and cached[0] == width:
+            height = cached[1]
+        elif message.uid in self._documents:
+            height = self._document(message, width).size().height()
+            self._heights[message.uid] = (width, height)
+        else:
+            height = self._estimate_height(message, width, option.fontMetrics)
+        return QtCore.QSize(width, int(height) + self.header_height + self.margin * 3)
+
+    def paint(self, painter, option, index):
+        message = index.data(MESSAGE_ROLE)
+        width = self._text_width()
+        document = self._document(message, width)
+
+        height = document.size().height()
+        if self._heights.get(message.uid) != (width, height):
+            self._heights[message.uid] = (width, height)
+            uid = message.uid
+            QtCore.QTimer.singleShot(0, lambda: self.invalidate(uid))
+
+        painter.save()
+        rect = option.rect.adjusted(self.margin // 2, self.margin // 2,
+                                    -self.margin // 2, -self.margin // 2)
+        painter.setPen(QtGui.QColor('#dcdcdc'))
+        painter.drawRoundedRect(rect, 4, 4)
+
+        name = '我' if message.role == 'user' else '机器人'
+        header_rect = QtCore.QRect(
+            rect.left() + self.margin, rect.top(),
+            rect.width() - self.margin * 2, self.header_height + self.margin)
+        painter.setPen(option.palette.text().color())
+        painter.drawText(
+            header_rect, QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+            '{} {}'.format(name, message.created_at.strftime('%Y-%m-%d %H:%M:%S')))
+
+        for action, button_rect in self._button_rects(option.rect, message):
+            self._icons[action].paint(painter, button_rect.adjusted(4, 4, -4, -4))
+
+        painter.translate(rect.left() + self.margin, header_rect.bottom())
+        document.drawContents(painter, QtCore.QRectF(0, 0, width, height))
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if (event.type() == QtCore.QEvent.MouseButtonRelease and
+                event.button() == QtCore.Qt.LeftButton):
+            message = index.data(MESSAGE_ROLE)
+            for action, button_rect in self._button_rects(option.rect, message):
+                if button_rect.contains(event.pos()):
+                    if action == 'copy':
+                        self.copied.emit(message.current_text())
+                    elif action == 'delete':
+                        self.deleted.emit(message.uid)
+                    elif action == 'stop':
+                        self.stopped.emit(message.uid)
+                    else:
+                        self.reloaded.emit(message.uid)
+                    return True
+        return super().editorEvent(event, model, option, index)
+
+    def _markdown_rendered(self, uid, text, html):
+        entry = self._documents.get(uid)
+        if entry is None or entry.streaming or entry.text != text:
+            # 文档已经被淘汰或者文本已经变化
+            return
+
+        entry.document.setHtml(html)
+        self.text_changed(uid)
+        self._view.viewport().update()
+
+    def invalidate(self, uid):
+        """ 消息内容或高度变化后通知视图重新布局 """
+        index = self._view.model().index_of(uid)
+        if index.isValid():
+            self.sizeHintChanged.emit(index)
+
+    def text_changed(self, uid):
+        self._heights.pop(uid, None)
+        self.invalidate(uid)
+
+    def forget(self, uid):
+        self._render_worker.cancel(uid)
+        self._heights.pop(uid, None)
+        entry = self._documents.pop(uid, None)
+        if entry:
+            entry.document.deleteLater()
+
+    def clear(self):
+        for entry in self._documents.values():
+            entry.document.deleteLater()
+        self._documents.clear()
+        self._heights.clear()
@@ -0,0 +1,61 @@
+import html
+import sys
+import traceback
+
+from PySide2 import QtCore
+
+from anywhere.markdown_convert import convert_markdown, get_cached_html
+
+
+class _RenderTask(QtCore.QRunnable):
+    def __init__(self, worker, uid, text):
+        super().__init__()
+        self._worker = worker
+        self.uid = uid
+        self.text = text
+
+    def run(self):
+        try:
+            result = convert_markdown(self.text)
+        except Exception:
+            # 渲染失败时显示原文，同样要发出结果，否则这条消息会一直停在等待渲染的状态
+            print('[markdown] 渲染失败：', file=sys.stderr)
+            traceback.print_exc()
+            result = html.escape(self.text).replace('\n', '<br>')
+        self._worker.rendered.emit(self.uid, self.text, result)
+
+
+class MarkdownRenderWorker(QtCore.QObject):
+    """
+    在后台线程池中渲染 Markdown，渲染完成后通过 rendered(uid, text, html) 通知界面线程。
+
+    接收方需要对比 text 与当前文本，丢弃已经过时的结果。
+    """
+
+    rendered = QtCore.Signal(str, str, str)
+
+    def __init__(self, max_threads=2, parent=None):
+        super().__init__(parent)
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(max_threads)
+        # {uid: text} 正在渲染中的请求，避免重复提交
+        self._pending = {}
+        self.rendered.connect(self._task_finished)
+
+    def render(self, uid, text):
+        """ 已有缓存时直接返回 HTML，否则提交后台渲染并返回 None """
+        html = get_cached_html(text)
+        if html is not None:
+            return html
+
+        if self._pending.get(uid) != text:
+            self._pending[uid] = text
+            self._pool.start(_RenderTask(self, uid, text))
+        return None
+
+    def _task_finished(self, uid, text, html):
+        if self._pending.get(uid) == text:
+            self._pending.pop(uid)
+
+    def cancel(self, uid):
+        self._pending.pop(uid, None)
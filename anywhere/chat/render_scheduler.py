@@ -0,0 +1,44 @@
+from collections import OrderedDict
+
+from PySide2 import QtCore
+
+
+class RenderScheduler(QtCore.QObject):
+    """ 缓存流式输出的增量，每个帧间隔最多调用一次 apply_func(item, text) 刷新界面 """
+
+    def __init__(self, apply_func, fps=30, parent=None):
+        super().__init__(parent)
+        self._apply_func = apply_func
+        # {item: [增量, ...]}
+        self._buffers = OrderedDict()
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.flush)
+        self.set_fps(fps)
+
+    def set_fps(self, fps):
+        self._timer.setInterval(max(1, int(1000 / max(fps, 1))))
+
+    def append(self, item, text):
+        self._buffers.setdefault(item, []).append(text)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self, item=None):
+        if item is not None:
+            chunks = self._buffers.pop(item, None)
+            if chunks:
+                self._apply_func(item, ''.join(chunks))
+            return
+
+        buffers, self._buffers = self._buffers, OrderedDict()
+        for item, chunks in buffers.items():
+            self._apply_func(item, ''.join(chunks))
+
+    def discard(self, item):
+        self._buffers.pop(item, None)
+
+    def clear(self):
+        self._buffers.clear()
+        self._timer.stop()
@@ -0,0 +1,290 @@
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from PySide2 import QtCore
+
+from anywhere.utils import get_config
+from anywhere.chat_client import chat_client, ChatCompletionError
+from anywhere.response_cache import get_response_cache, cacheable
+from anywhere.metrics import RequestMetrics, metrics_recorder
+from anywhere.tokens import token_counter
+
+
+class ChatRequest(QtCore.QObject):
+    # 流式输出时只发送增量 {'success', 'delta', 'final': False}，
+    # 结束或出错时发送完整内容 {'success', 'message', 'final': True}
+    show_message_signal = QtCore.Signal(dict)
+
+    # 命中缓存时按这个长度把回复切成增量依次发送，界面表现与真实的流式输出相同
+    replay_chunk_size = 16
+
+    def __init__(self, chat_name, message_id, messages, config, temperature, parent=None):
+        super().__init__(parent)
+        # 发起请求的聊天和回复消息的 id，输出始终写回这里，与界面当前选中的聊天无关
+        self.chat_name = chat_name
+        self.message_id = message_id
+        self.messages = messages
+        self.config = config
+        self.temperature = temperature
+        self.endpoint = chat_client.api_base(config)
+        self.metrics = RequestMetrics(chat_name, config.get('model'), self.endpoint)
+        # 当前显示这条回复的界面消息，切换聊天后可能为 None 或者被重新绑定
+        self.item = None
+        # 回复对应的消息被删除或重新生成后，后续输出不再写入聊天记录
+        self.detached = False
+        self._cancelled = threading.Event()
+        self._stream = None
+        self._lock = threading.Lock()
+
+        self.cache = None
+        self.cache_key = None
+        if cacheable(config, temperature):
+            self.cache = get_response_cache(config)
+            self.cache_key = self.cache.key(
+                self.endpoint, config['model'], messages, temperature)
+
+    def cancel(self):
+        """ 可以在界面线程调用，会立即关闭正在读取的连接 """
+        with self._lock:
+            self._cancelled.set()
+            stream = self._stream
+        if stream is not None:
+            stream.abort()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def _replay(self, content):
+        chunks = []
+        for start in range(0, len(content), self.replay_chunk_size):
+            if self.is_cancelled():
+                break
+            chunks.append(content[start:start + self.replay_chunk_size])
+            self.metrics.mark_chunk(chunks[-1])
+            self.show_message_signal.emit({
+                'success': True,
+                'delta': chunks[-1],
+                'final': False
+            })
+        message = ''.join(chunks)
+        self.metrics.mark_finished(
+            'cancelled' if self.is_cancelled() else 'cached', token_counter.count_text(message))
+        self.show_message_signal.emit({
+            'success': True,
+            'message': message,
+            'final': True,
+            'cancelled': self.is_cancelled(),
+            'cached': True
+        })
+
+    def _finish(self, status, message='', error=None):
+        stream = self._stream
+        self.metrics.mark_finished(
+            status, token_counter.count_text(message) if message else 0,
+            stream.bytes_received if stream is not None else 0, error)
+
+    def run(self):
+        self.metrics.mark_started()
+        chunks = []
+        try:
+            if self.is_cancelled():
+                raise ChatCompletionError('已取消')
+
+            if self.cache is not None:
+                content = self.cache.get(self.cache_key)
+                if content is not None:
+                    return self._replay(content)
+
+            stream = chat_client.open_stream(self.config, self.messages, self.temperature)
+            self.metrics.mark_connected()
+            with self._lock:
+                self._stream = stream
+            with stream:
+                if self.is_cancelled():
+                    raise ChatCompletionError('已取消')
+
+                for message_text in stream:
+                    chunks.append(message_text)
+                    self.metrics.mark_chunk(message_text)
+                    self.show_message_signal.emit({
+                        'success': True,
+                        'delta': message_text,
+                        'final': False
+                    })
+            message = ''.join(chunks)
+            if self.cache is not None and message and not self.is_cancelled():
+                self.cache.put(self.cache_key, message)
+            self._finish('cancelled' if self.is_cancelled() else 'ok', message)
+            self.show_message_signal.emit({
+                'success': True,
+                'message': message,
+                'final': True,
+                'cancelled': self.is_cancelled()
+            })
+        except Exception as e:
+            if self.is_cancelled():
+                # 取消时关闭连接引起的异常，保留已经收到的内容
+                self._finish('cancelled', ''.join(chunks))
+                self.show_message_signal.emit({
+                    'success': True,
+                    'message': ''.join(chunks),
+                    'final': True,
+                    'cancelled': True
+                })
+                return
+            self._finish('error', ''.join(chunks), str(e))
+            self.show_message_signal.emit({
+                'success': False,
+                'message': f'请求出错：\n{str(e)}',
+                'final': True
+            })
+
+
+class _RequestTask(QtCore.QRunnable):
+    def __init__(self, request):
+        super().__init__()
+        self.request = request
+
+    def run(self):
+        self.request.run()
+
+
+class RequestExecutor(QtCore.QObject):
+    """ 常驻的请求线程池，线程和其中的 HTTP 连接在请求之间复用，同时进行的请求数有上限 """
+
+    def __init__(self, max_concurrency=4, parent=None):
+        super().__init__(parent)
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(max_concurrency)
+        self._pool.setExpiryTimeout(-1)
+        # 保持请求对象存活，直到最终结果发出
+        self._requests = set()
+
+    def submit(self, request):
+        self._requests.add(request)
+        request.show_message_signal.connect(partial(self._request_message, request))
+        self._pool.start(_RequestTask(request))
+
+    def _request_message(self, request, data):
+        if data['final']:
+            self._requests.discard(request)
+
+
+class RequestScheduler(QtCore.QObject):
+    """
+    聊天请求调度。
+
+    请求先进入队列，再按接口地址限制同时进行的请求数和每分钟发起的请求数（0 表示不限制），
+    支持多个聊天同时流式输出，也可以按请求或按聊天取消。
+    """
+
+    def __init__(self, executor, max_per_endpoint=4, requests_per_minute=0, parent=None):
+        super().__init__(parent)
+        self.executor = executor
+        self.max_per_endpoint = max_per_endpoint
+        self.requests_per_minute = requests_per_minute
+
+        self._queue = deque()
+        # {endpoint: set(request)}
+        self._running = {}
+        # {endpoint: deque(最近一分钟内的开始时间)}
+        self._starts = {}
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._dispatch)
+
+    def submit(self, request):
+        request.show_message_signal.connect(partial(self._request_message, request))
+        self._queue.append(request)
+        self._dispatch()
+
+    def cancel(self, request):
+        if request in self._queue:
+            self._queue.remove(request)
+            request.cancel()
+            request.metrics.mark_finished('cancelled')
+            request.show_message_signal.emit({
+                'success': True,
+                'message': '',
+                'final': True,
+                'cancelled': True
+            })
+        else:
+            request.cancel()
+
+    def cancel_chat(self, chat_name):
+        for request in self.active_requests(chat_name):
+            self.cancel(request)
+
+    def rename_chat(self, old_name, chat_name):
+        for request in self.active_requests(old_name):
+            request.chat_name = chat_name
+
+    def active_requests(self, chat_name=None):
+        requests = list(self._queue)
+        for running in self._running.values():
+            requests.extend(running)
+        if chat_name is None:
+            return requests
+        return [r for r in requests if r.chat_name == chat_name]
+
+    def _rate_delay(self, endpoint, now):
+        if not self.requests_per_minute:
+            return 0
+
+        starts = self._starts.setdefault(endpoint, deque())
+        while starts and now - starts[0] >= 60:
+            starts.popleft()
+        if len(starts) < self.requests_per_minute:
+            return 0
+        return 60 - (now - starts[0])
+
+    def _dispatch(self):
+        now = time.monotonic()
+        wait = None
+        for request in list(self._queue):
+            running = self._running.setdefault(request.endpoint, set())
+            if len(running) >= self.max_per_endpoint:
+                continue
+
+            delay = self._rate_delay(request.endpoint, now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            self._queue.remove(request)
+            running.add(request)
+            self._starts.setdefault(request.endpoint, deque()).append(now)
+            self.executor.submit(request)
+
+        if wait is not None:
+            self._timer.start(int(wait * 1000) + 1)
+
+    def _request_message(self, request, data):
+        if not data['final']:
+            return
+
+        # 在界面处理完最终结果之后调用，统计中包含了最终结果的界面和存储耗时
+        metrics_recorder.record(request.metrics)
+        self._running.get(request.endpoint, set()).discard(request)
+        self._dispatch()
+
+
+_request_scheduler = None
+
+
+def get_request_scheduler():
+    global _request_scheduler
+
+    if _request_scheduler is None:
+        config = get_config('common')
+        max_concurrency = config.get('max_concurrent_requests', 4)
+        chat_client.pool_size = max_concurrency
+        _request_scheduler = RequestScheduler(
+            RequestExecutor(max_concurrency),
+            config.get('max_requests_per_endpoint', max_concurrency),
+            config.get('requests_per_minute', 0))
+    return _request_scheduler
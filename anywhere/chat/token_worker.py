@@ -0,0 +1,43 @@
+from PySide2 import QtCore
+
+from anywhere.tokens import token_counter, trim_messages_by_config
+
+
+class _CountTask(QtCore.QRunnable):
+    def __init__(self, worker, serial, reader, config):
+        super().__init__()
+        self._worker = worker
+        self.serial = serial
+        self.reader = reader
+        self.config = config
+
+    def run(self):
+        try:
+            messages = [message for _, message in self.reader() if not message.get('failed')]
+            total = token_counter.count_messages(messages)
+            sent = token_counter.count_messages(trim_messages_by_config(messages, self.config))
+        except Exception:
+            return
+        self._worker.counted.emit(self.serial, sent, total)
+
+
+class TokenCountWorker(QtCore.QObject):
+    """
+    在后台线程统计聊天的 token 数，完成后通过 counted(serial, sent, total) 通知界面线程。
+
+    每次 count 返回递增的 serial，接收方只处理最新一次的结果。
+    """
+
+    counted = QtCore.Signal(int, int, int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self.serial = 0
+
+    def count(self, reader, config):
+        """ reader 为 storage.messages_reader 返回的函数 """
+        self.serial += 1
+        self._pool.start(_CountTask(self, self.serial, reader, config))
+        return self.serial
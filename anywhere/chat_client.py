@@ -0,0 +1,126 @@
+import json
+import socket
+import threading
+
+DEFAULT_API_BASE = 'https://api.openai.com/v1'
+
+
+class ChatCompletionError(Exception):
+    pass
+
+
+class ChatStream(object):
+    """ 一次流式回复，迭代得到增量文本 """
+
+    def __init__(self, response):
+        self._response = response
+        # 收到的响应体字节数（按行统计，不含换行符以外的分隔）
+        self.bytes_received = 0
+
+    def __iter__(self):
+        done = False
+        for line in self._response.iter_lines():
+            self.bytes_received += len(line) + 1
+            # [DONE] 之后继续读完响应，连接才能放回连接池复用
+            if done or not line or not line.startswith(b'data:'):
+                continue
+
+            data = line[5:].strip()
+            if data == b'[DONE]':
+                done = True
+                continue
+
+            chunk = json.loads(data)
+            if 'error' in chunk:
+                raise ChatCompletionError(chunk['error'].get('message', data.decode()))
+            delta = chunk['choices'][0].get('delta', {})
+            if delta.get('content'):
+                yield delta['content']
+
+    def close(self):
+        self._response.close()
+
+    def abort(self):
+        """ 可以在其他线程调用，断开连接让正在阻塞的读取立即结束 """
+        try:
+            self._response.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChatCompletionClient(object):
+    """
+    OpenAI 兼容的 chat/completions 流式客户端。
+
+    每个接口地址复用一个 requests.Session，连接保持 keep-alive；
+    API Key 等凭据随每个请求单独传入，不修改任何全局变量，多个请求可以同时进行。
+    """
+
+    def __init__(self, pool_size=4, timeout=(10, 120)):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _session(self, api_base):
+        # requests 在第一次发送请求时才导入
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self._lock:
+            session = self._sessions.get(api_base)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[api_base] = session
+            return session
+
+    @staticmethod
+    def api_base(config):
+        return (config.get('proxy') or DEFAULT_API_BASE).rstrip('/')
+
+    def open_stream(self, config, messages, temperature):
+        """ 发送请求，返回可以逐个读取增量文本、也可以从其他线程关闭的 ChatStream """
+        api_base = self.api_base(config)
+        response = self._session(api_base).post(
+            '{}/chat/completions'.format(api_base),
+            headers={'Authorization': 'Bearer {}'.format(config['key'])},
+            json={
+                'model': config['model'],
+                'messages': messages,
+                'temperature': temperature,
+                'stream': True,
+            },
+            stream=True,
+            timeout=self.timeout,
+        )
+
+        if response.status_code != 200:
+            with response:
+                raise ChatCompletionError(self._error_message(response))
+        return ChatStream(response)
+
+    @staticmethod
+    def _error_message(response):
+        try:
+            return response.json()['error']['message']
+        except (ValueError, KeyError, TypeError):
+            return 'HTTP {}: {}'.format(response.status_code, response.text[:500])
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+chat_client = ChatCompletionClient()
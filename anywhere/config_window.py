@@ -4,6 +4,9 @@ from PySide2 import QtGui
 import qtawesome
 
 from anywhere.utils import get_config, save_config, CONFIG_PATH
+from anywhere.tokens import CONTEXT_POLICIES
+from anywhere.metrics import metrics_recorder
+from anywhere.watchdog import get_stall_watchdog
 from anywhere.widgets import show_message, show_question, create_h_spacer_item, signal_bus
 
 
@@ -58,10 +61,26 @@ class CommonPage(QtWidgets.QWidget):
         line_layout.addWidget(QtWidgets.QLabel('超级菜单快捷键:'), 4, 0)
         line_layout.addWidget(self.menu_line, 4, 1)
 
-        line_layout.addWidget(QtWidgets.QLabel('配置文件位置:'), 5, 0)
+        self.context_policy_box = QtWidgets.QComboBox(minimumHeight=30)
+        policy_names = ['发送全部消息', '只发送最近的消息', '较早的消息压缩成摘要']
+        for policy, name in zip(CONTEXT_POLICIES, policy_names):
+            self.context_policy_box.addItem(name, policy)
+        self.context_policy_box.setCurrentIndex(
+            max(self.context_policy_box.findData(self.config.get('context_policy', 'all')), 0))
+        line_layout.addWidget(QtWidgets.QLabel('上下文策略:'), 5, 0)
+        line_layout.addWidget(self.context_policy_box, 5, 1)
+
+        self.context_tokens_box = QtWidgets.QSpinBox(minimumHeight=30)
+        self.context_tokens_box.setRange(256, 1000000)
+        self.context_tokens_box.setSingleStep(256)
+        self.context_tokens_box.setValue(self.config.get('context_max_tokens', 3000))
+        line_layout.addWidget(QtWidgets.QLabel('上下文 token 上限:'), 6, 0)
+        line_layout.addWidget(self.context_tokens_box, 6, 1)
+
+        line_layout.addWidget(QtWidgets.QLabel('配置文件位置:'), 7, 0)
         path_label = QtWidgets.QLabel(CONFIG_PATH, minimumHeight=30)
         path_label.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
-        line_layout.addWidget(path_label, 5, 1)
+        line_layout.addWidget(path_label, 7, 1)
 
         button_layout = QtWidgets.QHBoxLayout()
         button_layout.setAlignment(QtCore.Qt.AlignRight)
@@ -82,7 +101,9 @@ class CommonPage(QtWidgets.QWidget):
             'key': self.key_line.text().strip(),
             'model': self.model_line.text().strip(),
             'chat_shortcut': self.chat_line.text().strip(),
-            'menu_shortcut': self.menu_line.text().strip()
+            'menu_shortcut': self.menu_line.text().strip(),
+            'context_policy': self.context_policy_box.currentData(),
+            'context_max_tokens': self.context_tokens_box.value()
         }
         save_config('common', data)
         signal_bus.config_saved.emit()
@@ -303,6 +324,156 @@ class PluginPage(QtWidgets.QWidget):
         layout.addWidget(QtWidgets.QLabel('插件配置页面'))
 
 
+class DiagnosticsPage(QtWidgets.QWidget):
+    """ 最近请求的耗时统计，页面显示时每秒刷新一次 """
+
+    columns = [
+        ('时间', 'created_at'),
+        ('聊天', 'chat_name'),
+        ('状态', 'status'),
+        ('排队', 'queue_wait'),
+        ('连接', 'connect_time'),
+        ('首字', 'ttft'),
+        ('总耗时', 'duration'),
+        ('token/s', 'tokens_per_second'),
+        ('token', 'tokens'),
+        ('接收字节', 'bytes_received'),
+        ('界面', 'ui_apply_time'),
+        ('界面最长', 'ui_apply_max'),
+        ('存储', 'persist_time'),
+    ]
+    # 这些列是秒，显示为毫秒
+    ms_columns = (
+        'queue_wait', 'connect_time', 'ttft', 'duration',
+        'ui_apply_time', 'ui_apply_max', 'persist_time')
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._init_ui()
+
+    def _init_ui(self):
+        self.summary_label = QtWidgets.QLabel()
+        self.summary_label.setWordWrap(True)
+
+        self.table_widget = QtWidgets.QTableWidget(0, len(self.columns))
+        self.table_widget.setHorizontalHeaderLabels([c[0] for c in self.columns])
+        self.table_widget.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table_widget.verticalHeader().setVisible(False)
+
+        # 界面卡顿按调用位置统计，没有开启卡顿检测时只显示提示
+        self.stall_label = QtWidgets.QLabel()
+        self.stall_table = QtWidgets.QTableWidget(0, 4)
+        self.stall_table.setHorizontalHeaderLabels(['调用位置', '次数', '总时长', '最长'])
+        self.stall_table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.stall_table.verticalHeader().setVisible(False)
+        self.stall_table.horizontalHeader().setSectionResizeMode(
+            0, QtWidgets.QHeaderView.Stretch)
+
+        export_button = QtWidgets.QPushButton('导出', minimumHeight=34, minimumWidth=86)
+        clear_button = QtWidgets.QPushButton('清空', minimumHeight=34, minimumWidth=86)
+        button_layout = QtWidgets.QHBoxLayout()
+        button_layout.addItem(create_h_spacer_item())
+        button_layout.addWidget(clear_button)
+        button_layout.addWidget(export_button)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.summary_label)
+        layout.addWidget(self.table_widget, 2)
+        layout.addWidget(self.stall_label)
+        layout.addWidget(self.stall_table, 1)
+        layout.addLayout(button_layout)
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(1000)
+        self._timer.timeout.connect(self.refresh)
+
+        export_button.clicked.connect(self.export_button_clicked)
+        clear_button.clicked.connect(self.clear_button_clicked)
+
+    def showEvent(self, event):
+        self.refresh()
+        self._timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self._timer.stop()
+        super().hideEvent(event)
+
+    def _format(self, key, value):
+        if value is None:
+            return '-'
+        if key == 'created_at':
+            return QtCore.QDateTime.fromSecsSinceEpoch(int(value)).toString('HH:mm:ss')
+        if key in self.ms_columns:
+            return '{:.0f} ms'.format(value * 1000)
+        if isinstance(value, float):
+            return '{:.1f}'.format(value)
+        return str(value)
+
+    def refresh(self):
+        summary = metrics_recorder.summary()
+        self.summary_label.setText(
+            '请求 {} 次，出错 {} 次，取消 {} 次，命中缓存 {} 次；'
+            '平均首字 {}，首字 p95 {}，平均 {} token/s，界面单次最长 {}'.format(
+                summary['requests'], summary['errors'], summary['cancelled'], summary['cached'],
+                self._format('ttft', summary['ttft_mean']),
+                self._format('ttft', summary['ttft_p95']),
+                self._format('tokens_per_second', summary['tokens_per_second_mean']),
+                self._format('ui_apply_max', summary['ui_apply_max'])))
+
+        records = list(reversed(metrics_recorder.recent()))
+        self.table_widget.setRowCount(len(records))
+        for row, data in enumerate(records):
+            for column, (_, key) in enumerate(self.columns):
+                item = QtWidgets.QTableWidgetItem(self._format(key, data[key]))
+                if key == 'status' and data['error']:
+                    item.setToolTip(data['error'])
+                self.table_widget.setItem(row, column, item)
+
+        self.refresh_stalls()
+
+    def refresh_stalls(self):
+        watchdog = get_stall_watchdog()
+        self.stall_table.setVisible(watchdog is not None)
+        if watchdog is None:
+            self.stall_label.setText('卡顿检测未开启，可以在公共配置中设置 stall_watchdog 开启')
+            return
+
+        stats = watchdog.stats()
+        self.stall_label.setText(
+            '界面卡顿（超过 {:.0f} ms）{} 次，事件循环平均延迟 {}，最大延迟 {}'.format(
+                stats['threshold'] * 1000, stats['stalls'],
+                self._format('duration', stats['loop_lag_mean']),
+                self._format('duration', stats['loop_lag_max'])))
+
+        report = watchdog.report()
+        self.stall_table.setRowCount(len(report))
+        for row, data in enumerate(report):
+            values = [
+                data['site'], str(data['count']),
+                self._format('duration', data['total']), self._format('duration', data['max'])]
+            for column, value in enumerate(values):
+                item = QtWidgets.QTableWidgetItem(value)
+                # 鼠标悬停时显示最长一次卡顿的调用栈
+                item.setToolTip(data['stack'])
+                self.stall_table.setItem(row, column, item)
+
+    def export_button_clicked(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, '导出请求统计', 'metrics.jsonl', 'JSON Lines (*.jsonl)')
+        if not path:
+            return
+        metrics_recorder.export(path)
+        show_message('导出成功')
+
+    def clear_button_clicked(self):
+        metrics_recorder.clear()
+        watchdog = get_stall_watchdog()
+        if watchdog:
+            watchdog.clear()
+        self.refresh()
+
+
 class ConfigWidget(QtWidgets.QWidget):
     def __init__(self, *args, **kwargs):
         super(ConfigWidget, self).__init__(*args, **kwargs)
@@ -335,6 +506,7 @@ class ConfigWidget(QtWidgets.QWidget):
         self.create_list_item('公共配置')
         self.create_list_item('角色配置')
         self.create_list_item('插件配置')
+        self.create_list_item('诊断信息')
 
         self.common_widget = CommonPage(self.config.get('common', {}), self)
         self.stacked_widget.addWidget(self.common_widget)
@@ -345,6 +517,9 @@ class ConfigWidget(QtWidgets.QWidget):
         self.plugin_widget = PluginPage(self.config.get('plugins', {}), self)
         self.stacked_widget.addWidget(self.plugin_widget)
 
+        self.diagnostics_widget = DiagnosticsPage(self)
+        self.stacked_widget.addWidget(self.diagnostics_widget)
+
         self.list_widget.setCurrentRow(0)
 
     def create_list_item(self, name):
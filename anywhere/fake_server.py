@@ -0,0 +1,278 @@
+"""
+本地模拟的 OpenAI 兼容接口，只实现 chat/completions，用来在没有网络的情况下复现吞吐和卡顿问题。
+
+    python -m anywhere.fake_server --port 8765 --tokens-per-second 30 --ttft 0.5
+
+然后把公共配置中的代理地址设置为 http://127.0.0.1:8765/v1 即可。
+相同的 --seed 和请求顺序下，注入的错误和断开位置是确定的。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    '这是一条来自本地模拟接口的回复。它会按照设置的速度逐段返回，'
+    '用来测试流式输出、渲染和请求调度。\n\n'
+    '```python\nprint("hello anywhere")\n```\n\n'
+    '- 第一项\n- 第二项\n- 第三项\n'
+)
+
+
+class FakeServerConfig(object):
+    def __init__(self, tokens_per_second=50, chunk_size=1, ttft=0.2, reply_tokens=200,
+                 error_rate=0, error_status=500, drop_rate=0, stall_rate=0,
+                 stall_seconds=5, seed=None):
+        # 每秒输出的 token 数，0 表示不限速
+        self.tokens_per_second = tokens_per_second
+        # 每个 SSE 事件包含的 token 数
+        self.chunk_size = chunk_size
+        # 收到请求到第一个 token 的时间（秒）
+        self.ttft = ttft
+        self.reply_tokens = reply_tokens
+        # 直接返回错误状态码的概率
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # 输出中途断开连接的概率
+        self.drop_rate = drop_rate
+        # 输出中途停顿 stall_seconds 秒的概率
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.seed = seed
+
+
+def split_tokens(text):
+    """ 粗略切分：英文按单词（带后面的空白），其他字符逐个作为 token """
+    tokens = []
+    word = ''
+    for char in text:
+        if char.isascii() and char.isalnum():
+            word += char
+            continue
+        if word:
+            tokens.append(word)
+            word = ''
+        if char.isspace() and tokens:
+            tokens[-1] += char
+        else:
+            tokens.append(char)
+    if word:
+        tokens.append(word)
+    return tokens
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # 使用 HTTP/1.1 和分块传输，客户端可以复用连接
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, {'error': {'message': 'not found: {}'.format(self.path)}})
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._send_json(400, {'error': {'message': 'invalid json'}})
+
+        config = self.server.config
+        plan = self.server.plan()
+        if plan['error']:
+            return self._send_json(config.error_status, {
+                'error': {'message': '模拟错误 {}'.format(config.error_status)}})
+
+        tokens = self.server.reply_tokens(body)
+        if body.get('stream'):
+            self._stream(body, tokens, plan)
+        else:
+            time.sleep(config.ttft)
+            self._send_json(200, self._completion(body, ''.join(tokens)))
+
+    def _send_json(self, status, data):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    @staticmethod
+    def _completion(body, text):
+        return {
+            'id': 'chatcmpl-{}'.format(uuid.uuid4().hex),
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': text},
+                'finish_reason': 'stop',
+            }],
+        }
+
+    def _write_chunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii'))
+        self.wfile.write(data)
+        self.wfile.write(b'\r\n')
+        self.wfile.flush()
+
+    def _write_event(self, data):
+        self._write_chunk('data: {}\n\n'.format(data).encode('utf-8'))
+
+    def _stream(self, body, tokens, plan):
+        config = self.server.config
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        completion_id = 'chatcmpl-{}'.format(uuid.uuid4().hex)
+        interval = config.chunk_size / config.tokens_per_second if config.tokens_per_second else 0
+
+        def event(delta, finish_reason=None):
+            return json.dumps({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }, ensure_ascii=False)
+
+        try:
+            time.sleep(config.ttft)
+            self._write_event(event({'role': 'assistant'}))
+            for start in range(0, len(tokens), config.chunk_size):
+                # 同一位置先停顿再断开，两种故障都按设置的概率出现
+                if start == plan['stall_at']:
+                    time.sleep(config.stall_seconds)
+                if start == plan['drop_at']:
+                    # 不发送结束标记直接断开
+                    self.close_connection = True
+                    return
+                self._write_event(event({'content': ''.join(tokens[start:start + config.chunk_size])}))
+                if interval:
+                    time.sleep(interval)
+
+            self._write_event(event({}, 'stop'))
+            self._write_event('[DONE]')
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求
+            self.close_connection = True
+
+
+class FakeChatServer(ThreadingHTTPServer):
+    """ 可以在测试或基准测试中直接在后台线程启动 """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, config=None, verbose=False):
+        super().__init__((host, port), _Handler)
+        self.config = config or FakeServerConfig()
+        self.verbose = verbose
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def api_base(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/v1'.format(host, port)
+
+    def plan(self):
+        """
+        按请求到达的顺序决定这次是否出错、在哪里断开或停顿。
+
+        位置是某个内容事件开始的 token 下标，在这个事件发送之前断开或停顿，
+        从所有事件中均匀选取，一定会到达，实际的故障比例与设置的概率一致。
+        同时断开和停顿时，停顿的位置不会在断开之后。
+        """
+        config = self.config
+        events = max((config.reply_tokens + config.chunk_size - 1) // config.chunk_size, 1)
+        with self._lock:
+            error = self._random.random() < config.error_rate
+            drop = self._random.random() < config.drop_rate
+            stall = self._random.random() < config.stall_rate
+            positions = sorted(self._random.randrange(events) * config.chunk_size
+                               for _ in range(2))
+        return {
+            'error': error,
+            'drop_at': positions[1] if drop else None,
+            'stall_at': positions[0] if stall else None,
+        }
+
+    def reply_tokens(self, body):
+        """ 回复内容由最后一条用户消息和固定文本组成，截断到 reply_tokens 个 token """
+        question = ''
+        for message in reversed(body.get('messages', [])):
+            if message.get('role') == 'user':
+                question = message.get('content', '')
+                break
+
+        tokens = split_tokens('收到：{}\n\n'.format(question[:100]))
+        filler = split_tokens(DEFAULT_REPLY)
+        while len(tokens) < self.config.reply_tokens:
+            tokens.extend(filler)
+        return tokens[:self.config.reply_tokens]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地模拟的 OpenAI 流式接口')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='0 表示不限速')
+    parser.add_argument('--chunk-size', type=int, default=1, help='每个事件包含的 token 数')
+    parser.add_argument('--ttft', type=float, default=0.2, help='第一个 token 之前的等待秒数')
+    parser.add_argument('--reply-tokens', type=int, default=200, help='每次回复的 token 数')
+    parser.add_argument('--error-rate', type=float, default=0, help='返回错误状态码的概率')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--drop-rate', type=float, default=0, help='输出中途断开连接的概率')
+    parser.add_argument('--stall-rate', type=float, default=0, help='输出中途停顿的概率')
+    parser.add_argument('--stall-seconds', type=float, default=5)
+    parser.add_argument('--seed', type=int, help='随机种子，设置后注入的故障可以复现')
+    parser.add_argument('--verbose', action='store_true', help='输出每个请求的日志')
+    args = parser.parse_args(argv)
+
+    config = FakeServerConfig(
+        tokens_per_second=args.tokens_per_second,
+        chunk_size=max(args.chunk_size, 1),
+        ttft=args.ttft,
+        reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        drop_rate=args.drop_rate,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+        seed=args.seed,
+    )
+    server = FakeChatServer(args.host, args.port, config, args.verbose)
+    print('模拟接口已启动，请把代理地址设置为 {}'.format(server.api_base))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,29 @@
+import os
 import sys
+import time
+
+_startup_time = time.perf_counter()
 
 from PySide2 import QtWidgets
+from PySide2 import QtCore
 from PySide2 import QtGui
 
-from anywhere.config_window import ConfigWidget
-from anywhere.chat.chat_window import ChatWindow
-from anywhere.widgets import signal_bus
+from anywhere.signals import signal_bus
 from anywhere.utils import get_config
+from anywhere.storage import chat_history_storage
 from anywhere.hotkey import HotkeyThread
 
+# 设置 ANYWHERE_STARTUP_TIMING=1 时输出启动各阶段的耗时，设置为 exit 时测量完成后直接退出
+STARTUP_TIMING = os.environ.get('ANYWHERE_STARTUP_TIMING', '')
+# 设置 ANYWHERE_WATCHDOG=1 时开启卡顿检测，每次卡顿和退出时的统计都输出到 stderr
+WATCHDOG = os.environ.get('ANYWHERE_WATCHDOG', '')
+
+
+def log_startup(stage):
+    if STARTUP_TIMING:
+        print('[startup] {}: {:.1f} ms'.format(
+            stage, (time.perf_counter() - _startup_time) * 1000), file=sys.stderr)
+
 
 class TrayIcon(QtWidgets.QSystemTrayIcon):
     def __init__(self, parent=None):
@@ -16,8 +31,9 @@ class TrayIcon(QtWidgets.QSystemTrayIcon):
         self.setToolTip('Chuangyi Sitter')
         self.setIcon(QtGui.QIcon('resources/images/publish.png'))
 
-        self.config_widget = ConfigWidget()
-        self.chat_window = ChatWindow()
+        # 窗口在第一次使用时才创建，fast_start 关闭时启动时立即创建
+        self._config_widget = None
+        self._chat_window = None
         self.hotkey_thread = None
 
         self._config_saved()
@@ -29,6 +45,45 @@ class TrayIcon(QtWidgets.QSystemTrayIcon):
 
         self.bubble('托盘启动成功！')
 
+        config = get_config('common')
+        if not config.get('fast_start', True):
+            self._ensure_windows()
+        elif config.get('prewarm_windows', True) or STARTUP_TIMING == 'exit':
+            # 托盘显示后等事件循环空闲时预先创建窗口，窗口仍然在界面线程中创建
+            QtCore.QTimer.singleShot(config.get('prewarm_delay', 1000), self._prewarm)
+
+    def _ensure_windows(self, chat=True, config=True):
+        """ 创建还没有创建的窗口 """
+        if chat and self._chat_window is None:
+            from anywhere.chat.chat_window import ChatWindow
+            self._chat_window = ChatWindow()
+            log_startup('聊天窗口创建完成')
+        if config and self._config_widget is None:
+            from anywhere.config_window import ConfigWidget
+            self._config_widget = ConfigWidget()
+            log_startup('配置窗口创建完成')
+
+    @property
+    def chat_window(self):
+        self._ensure_windows(config=False)
+        return self._chat_window
+
+    @property
+    def config_widget(self):
+        self._ensure_windows(chat=False)
+        return self._config_widget
+
+    def _prewarm(self):
+        # 分两次创建，中间让出事件循环，避免一次阻塞界面太久
+        self._ensure_windows(config=False)
+        QtCore.QTimer.singleShot(0, self._prewarm_finished)
+
+    def _prewarm_finished(self):
+        self._ensure_windows(chat=False)
+        log_startup('预先创建窗口完成')
+        if STARTUP_TIMING == 'exit':
+            QtWidgets.QApplication.quit()
+
     def _connect(self):
         signal_bus.config_saved.connect(self._config_saved)
 
@@ -47,7 +102,7 @@ class TrayIcon(QtWidgets.QSystemTrayIcon):
 
     def _shortcut_triggered(self, action_name):
         action_map = {
-            'show_chat': self.chat_window.show
+            'show_chat': lambda: self.chat_window.show()
         }
         action_map[action_name]()
 
@@ -62,7 +117,7 @@ class TrayIcon(QtWidgets.QSystemTrayIcon):
         self.tray_menu = QtWidgets.QMenu()
 
         self.config_action = QtWidgets.QAction(
-            '配置', triggered=self.config_widget.show)
+            '配置', triggered=lambda: self.config_widget.show())
         self.quit_action = QtWidgets.QAction(
             '退出', triggered=QtWidgets.QApplication.quit
         )
@@ -80,9 +135,28 @@ class Tray(QtWidgets.QApplication):
     def __init__(self):
         super(Tray, self).__init__(sys.argv)
         self.setQuitOnLastWindowClosed(False)
+        # 退出前把流式输出中暂存的回复写入聊天记录
+        self.aboutToQuit.connect(chat_history_storage.close)
 
         self.tray_icon = TrayIcon(self)
         self.tray_icon.show()
+        log_startup('托盘显示')
+        # 事件循环开始处理事件时界面才真正可以响应
+        QtCore.QTimer.singleShot(0, lambda: log_startup('事件循环启动'))
+
+        config = get_config('common')
+        if config.get('stall_watchdog') or WATCHDOG:
+            # 等事件循环开始后再启动，避免把启动过程当成卡顿
+            QtCore.QTimer.singleShot(0, lambda: self._start_watchdog(config))
+
+    def _start_watchdog(self, config):
+        from anywhere.watchdog import start_stall_watchdog
+
+        watchdog = start_stall_watchdog(
+            config.get('stall_threshold_ms', 50) / 1000, log=bool(WATCHDOG), parent=self)
+        self.aboutToQuit.connect(watchdog.stop)
+        if WATCHDOG:
+            self.aboutToQuit.connect(lambda: print(watchdog.format_report(), file=sys.stderr))
 
     def run(self):
         sys.exit(self.exec_())
@@ -1,11 +1,274 @@
-import markdown
-from anywhere.utils import RESOURCES_PATH
+import hashlib
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
 
+from anywhere.utils import RESOURCES_PATH, CONFIG_ROOT, get_config
+
+# 渲染方式变化时修改版本号，让磁盘上的旧缓存失效
+RENDER_VERSION = '2'
+MARKDOWN_CACHE_PATH = '{}/cache/markdown'.format(CONFIG_ROOT)
 
 with open(f'{RESOURCES_PATH}/css/code.css', encoding='utf-8') as f:
     style = f.read()
 
 
+class RenderCache(object):
+    """ 以内容哈希为键的渲染结果缓存，内存部分按字节数做 LRU 淘汰，可选持久化到磁盘 """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, disk_path=None):
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(
+            '{}\0{}'.format(RENDER_VERSION, text).encode('utf-8')).hexdigest()
+
+    def _disk_file(self, key):
+        return '{}/{}/{}.html'.format(self.disk_path, key[:2], key)
+
+    def get(self, key):
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return html
+
+        if self.disk_path:
+            try:
+                with open(self._disk_file(key), encoding='utf-8') as f:
+                    html = f.read()
+            except OSError:
+                pass
+            else:
+                self.disk_hits += 1
+                self._put_memory(key, html)
+                return html
+
+        self.misses += 1
+        return None
+
+    def put(self, key, html):
+        self._put_memory(key, html)
+
+        if self.disk_path:
+            path = self._disk_file(key)
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(html)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
+
+    def _put_memory(self, key, html):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= sys.getsizeof(old)
+            self._items[key] = html
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= sys.getsizeof(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+render_cache = RenderCache(
+    disk_path=MARKDOWN_CACHE_PATH
+    if get_config('common').get('markdown_disk_cache') else None)
+
+
+class MarkdownRenderer(object):
+    """ 复用同一个已加载扩展的 Markdown 实例，每次转换前 reset """
+
+    def __init__(self):
+        # markdown 和 pygments 在第一次渲染时才导入
+        import markdown
+        self._md = markdown.Markdown(extensions=['fenced_code', 'codehilite'])
+
+    def convert(self, text):
+        return self._md.reset().convert(text)
+
+
+# Markdown 实例不是线程安全的，每个渲染线程各用一个
+_local = threading.local()
+
+
+def convert_markdown(text, cache=True):
+    """ 直接渲染，不查询缓存，cache 为 True 时把结果写入缓存 """
+    renderer = getattr(_local, 'renderer', None)
+    if renderer is None:
+        renderer = _local.renderer = MarkdownRenderer()
+    html = renderer.convert(text)
+    if cache:
+        render_cache.put(render_cache.key(text), html)
+    return html
+
+
+def get_cached_html(text):
+    return render_cache.get(render_cache.key(text))
+
+
+def render_markdown(text):
+    html = get_cached_html(text)
+    if html is None:
+        html = convert_markdown(text)
+    return html
+
+
+FENCE_RE = re.compile(r'^(`{3,}|~{3,})')
+LIST_ITEM_RE = re.compile(r'^\s*([-*+]|\d+[.)])\s')
+REFERENCE_RE = re.compile(r'^ {0,3}\[([^\]]+)\]:\s*\S')
+
+
+class IncrementalMarkdownRenderer(object):
+    """
+    流式输出时的增量渲染。
+
+    在段落结束（代码块外的空行）或代码块闭合处切分文本，已完成的块只渲染一次，
+    之后每次只重新渲染末尾还没有完成的块。空行后面是列表项、引用或缩进的内容时不切分，
+    否则松散列表会被拆成几个列表，有序列表的序号也会从头开始。
+
+    链接定义（[ref]: url）收集起来附加到之后每个块的末尾，单独渲染的块也能解析引用链接；
+    定义出现之前已经完成的块不会重新渲染。
+    """
+
+    def __init__(self):
+        self._tail = ''
+        self._scan_pos = 0
+        self._fence = None
+        self._references = OrderedDict()
+
+    def feed(self, text):
+        """ 追加增量，返回这次新完成的块的 HTML 列表 """
+        self._tail += text
+
+        blocks = []
+        while True:
+            end = self._find_block_end()
+            if end is None:
+                break
+
+            block, self._tail = self._tail[:end], self._tail[end:]
+            self._scan_pos = 0
+            if block.strip():
+                blocks.append(render_markdown(self._with_references(block)))
+                self._collect_references(block)
+        return blocks
+
+    def _collect_references(self, block):
+        fence = None
+        for line in block.split('\n'):
+            if fence:
+                if line.rstrip() == fence:
+                    fence = None
+                continue
+
+            match = FENCE_RE.match(line)
+            if match:
+                fence = match.group(1)
+                continue
+
+            match = REFERENCE_RE.match(line)
+            if match:
+                # 与 markdown 一致，同名的定义以后出现的为准
+                self._references[match.group(1).lower()] = line.strip()
+
+    def _with_references(self, text):
+        if not self._references:
+            return text
+        return '{}\n\n{}\n'.format(text.rstrip('\n'), '\n'.join(self._references.values()))
+
+    def _find_block_end(self):
+        while True:
+            line_start = self._scan_pos
+            line_end = self._tail.find('\n', line_start)
+            if line_end < 0:
+                return None
+
+            line = self._tail[line_start:line_end]
+            self._scan_pos = line_end + 1
+            if self._fence:
+                if line.rstrip() == self._fence:
+                    self._fence = None
+                    return self._scan_pos
+                continue
+
+            match = FENCE_RE.match(line)
+            if match:
+                self._fence = match.group(1)
+            elif not line.strip() and self._tail[:line_end].strip():
+                continues = self._continues_block(self._scan_pos)
+                if continues is None:
+                    # 下一行还没有收完，下次从这个空行重新判断
+                    self._scan_pos = line_start
+                    return None
+                if not continues:
+                    return self._scan_pos
+
+    def _continues_block(self, pos):
+        """ 空行之后的第一行是否还属于前面的块，这一行还没有收完时返回 None """
+        while True:
+            line_end = self._tail.find('\n', pos)
+            if line_end < 0:
+                return None
+
+            line = self._tail[pos:line_end]
+            if line.strip():
+                return line[:1] in (' ', '\t', '>') or bool(LIST_ITEM_RE.match(line))
+            pos = line_end + 1
+
+    def tail_html(self):
+        """ 渲染末尾未完成的块，未闭合的代码块先临时补上结束标记 """
+        tail = self._tail
+        if not tail.strip():
+            return ''
+        if self._fence:
+            tail = '{}\n{}\n'.format(tail.rstrip('\n'), self._fence)
+        return convert_markdown(self._with_references(tail), cache=False)
+
+
 def markdown_to_html(text):
-    html = markdown.markdown(text, extensions=['fenced_code', 'codehilite'])
-    return f'<style>{style}</style>{html}'
+    """ 返回不带样式的 HTML，代码高亮样式由 apply_code_style 设置到文档上 """
+    return render_markdown(text)
+
+
+def apply_code_style(document):
+    document.setDefaultStyleSheet(style)
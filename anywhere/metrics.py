@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from anywhere.utils import METRICS_PATH, get_config
+
+
+class RequestMetrics(object):
+    """
+    一次聊天请求各阶段的耗时统计。
+
+    mark_* 在请求线程中调用，add_ui_apply/add_persist 在界面线程中调用，时间单位都是秒。
+    """
+
+    def __init__(self, chat_name, model, endpoint):
+        self.chat_name = chat_name
+        self.model = model
+        self.endpoint = endpoint
+        self.created_at = time.time()
+        self.status = None
+        self.error = None
+
+        self._queued = time.perf_counter()
+        self._started = None
+        self._connected = None
+        self._first_chunk = None
+        self._finished = None
+
+        self.chunks = 0
+        self.chars = 0
+        self.tokens = 0
+        self.bytes_received = 0
+        # 界面线程把增量应用到消息上的耗时
+        self.ui_apply_time = 0
+        self.ui_apply_max = 0
+        self.ui_apply_count = 0
+        # 写入聊天记录的耗时
+        self.persist_time = 0
+
+    def mark_started(self):
+        self._started = time.perf_counter()
+
+    def mark_connected(self):
+        self._connected = time.perf_counter()
+
+    def mark_chunk(self, text):
+        if self._first_chunk is None:
+            self._first_chunk = time.perf_counter()
+        self.chunks += 1
+        self.chars += len(text)
+
+    def mark_finished(self, status, tokens=0, bytes_received=0, error=None):
+        self._finished = time.perf_counter()
+        self.status = status
+        self.tokens = tokens
+        self.bytes_received = bytes_received
+        self.error = error
+
+    def add_ui_apply(self, seconds):
+        self.ui_apply_time += seconds
+        self.ui_apply_max = max(self.ui_apply_max, seconds)
+        self.ui_apply_count += 1
+
+    def add_persist(self, seconds):
+        self.persist_time += seconds
+
+    @staticmethod
+    def _span(start, end):
+        if start is None or end is None:
+            return None
+        return end - start
+
+    def to_dict(self):
+        generate_time = self._span(self._first_chunk, self._finished)
+        return {
+            'created_at': self.created_at,
+            'chat_name': self.chat_name,
+            'model': self.model,
+            'endpoint': self.endpoint,
+            'status': self.status,
+            'error': self.error,
+            'queue_wait': self._span(self._queued, self._started),
+            'connect_time': self._span(self._started, self._connected),
+            'ttft': self._span(self._started, self._first_chunk),
+            'duration': self._span(self._started, self._finished),
+            'tokens_per_second': (
+                self.tokens / generate_time if generate_time and self.tokens else None),
+            'chunks': self.chunks,
+            'chars': self.chars,
+            'tokens': self.tokens,
+            'bytes_received': self.bytes_received,
+            'ui_apply_time': self.ui_apply_time,
+            'ui_apply_max': self.ui_apply_max,
+            'ui_apply_count': self.ui_apply_count,
+            'persist_time': self.persist_time,
+        }
+
+
+class MetricsRecorder(object):
+    """ 保存最近的请求统计，开启 metrics_log 时同时追加写入 metrics.jsonl """
+
+    def __init__(self, max_records=200, path=METRICS_PATH):
+        self.path = path
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def record(self, metrics):
+        data = metrics.to_dict()
+        with self._lock:
+            self._records.append(data)
+        if get_config('common').get('metrics_log'):
+            self._write(self.path, [data], 'a')
+
+    def recent(self):
+        with self._lock:
+            return list(self._records)
+
+    def summary(self):
+        records = self.recent()
+
+        def values(key):
+            return sorted(r[key] for r in records if r[key] is not None)
+
+        def mean(items):
+            return sum(items) / len(items) if items else None
+
+        def p95(items):
+            return items[min(int(len(items) * 0.95), len(items) - 1)] if items else None
+
+        ttft = values('ttft')
+        return {
+            'requests': len(records),
+            'errors': sum(1 for r in records if r['status'] == 'error'),
+            'cancelled': sum(1 for r in records if r['status'] == 'cancelled'),
+            'cached': sum(1 for r in records if r['status'] == 'cached'),
+            'queue_wait_mean': mean(values('queue_wait')),
+            'ttft_mean': mean(ttft),
+            'ttft_p95': p95(ttft),
+            'tokens_per_second_mean': mean(values('tokens_per_second')),
+            'ui_apply_max': max(values('ui_apply_max'), default=None),
+        }
+
+    def export(self, path):
+        """ 把最近的统计写入 JSONL 文件 """
+        self._write(path, self.recent(), 'w')
+
+    @staticmethod
+    def _write(path, records, mode):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, mode, encoding='utf-8') as f:
+            for data in records:
+                f.write(json.dumps(data, ensure_ascii=False))
+                f.write('\n')
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+metrics_recorder = MetricsRecorder()
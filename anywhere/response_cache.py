@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from anywhere.utils import RESPONSE_CACHE_DB
+
+
+class ResponseCache(object):
+    """
+    本地回复缓存，保存在 SQLite 中。
+
+    以接口地址、模型、消息和采样参数的哈希为键，不同服务上同名的模型不会共用缓存。
+    超过 ttl 秒的记录视为过期，记录数超过 max_entries 时淘汰最久没有使用的。
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_DB, ttl=7 * 24 * 3600, max_entries=500):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 读写都在请求线程中进行
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL
+                )
+            ''')
+
+    @staticmethod
+    def key(endpoint, model, messages, temperature):
+        data = json.dumps({
+            'endpoint': endpoint,
+            'model': model,
+            'messages': messages,
+            'temperature': temperature,
+        }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        try:
+            return self._get(key)
+        except sqlite3.Error:
+            # 缓存出错时当作没有命中，不影响正常请求
+            return None
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT content, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE responses SET used_at = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def put(self, key, content):
+        try:
+            self._put(key, content)
+        except sqlite3.Error:
+            pass
+
+    def _put(self, key, content):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, content, created_at, used_at) '
+                'VALUES (?, ?, ?, ?)', (key, content, now, now))
+            self._conn.execute(
+                'DELETE FROM responses WHERE created_at < ?', (now - self.ttl,))
+            self._conn.execute('''
+                DELETE FROM responses WHERE key NOT IN (
+                    SELECT key FROM responses ORDER BY used_at DESC LIMIT ?
+                )
+            ''', (self.max_entries,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM responses')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_response_cache = None
+
+
+def get_response_cache(config):
+    """ 没有开启 response_cache 时返回 None """
+    global _response_cache
+
+    if not config.get('response_cache'):
+        return None
+    if _response_cache is None:
+        _response_cache = ResponseCache(
+            ttl=config.get('response_cache_ttl', 7 * 24 * 3600),
+            max_entries=config.get('response_cache_max_entries', 500))
+    return _response_cache
+
+
+def cacheable(config, temperature):
+    """ 默认只缓存 temperature 为 0 的请求，否则重新生成总会得到同样的回复 """
+    return (get_response_cache(config) is not None and
+            temperature <= config.get('response_cache_max_temperature', 0))
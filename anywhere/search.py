@@ -0,0 +1,367 @@
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+from anywhere.utils import SEARCH_INDEX_DB
+from anywhere.storage import chat_history_storage
+
+# 索引格式变化时修改，已有的索引会在下次搜索时重建
+INDEX_VERSION = 1
+
+CJK_CHARS = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+TERM_RE = re.compile(r'([{0}]+)|([^\W_{0}]+)'.format(CJK_CHARS))
+# 用前瞻匹配取出所有相邻的两个字，避免逐个字符循环
+BIGRAM_RE = re.compile(r'(?=([{0}]{{2}}))'.format(CJK_CHARS))
+CHAR_RE = re.compile(r'[{0}]'.format(CJK_CHARS))
+WORD_RE = re.compile(r'[^\W_{0}]+'.format(CJK_CHARS))
+
+
+def normalize(text):
+    """ 全角转半角、统一小写 """
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def _bigrams(text):
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+def tokenize(text):
+    """
+    返回 (grams, chars, words)，中日韩文字按相邻两个字切分成 grams，单字另外放在 chars 中，
+    其他文字按单词放在 words 中。grams 保持原来的顺序，连续的几个字可以按短语查询。
+    """
+    text = normalize(text)
+    return BIGRAM_RE.findall(text), CHAR_RE.findall(text), WORD_RE.findall(text)
+
+
+def build_query(text):
+    """ 把搜索内容转换成 FTS5 查询，所有词都要出现，英文单词按前缀匹配 """
+    parts = []
+    for cjk, word in TERM_RE.findall(normalize(text)):
+        if word:
+            parts.append('words : "{}"*'.format(word))
+        elif len(cjk) == 1:
+            parts.append('chars : "{}"'.format(cjk))
+        else:
+            parts.append('grams : "{}"'.format(' '.join(_bigrams(cjk))))
+    return ' AND '.join(parts)
+
+
+def make_snippet(content, text, width=60):
+    """ 截取第一个匹配位置附近的内容 """
+    lower = content.lower()
+    position = -1
+    for term in normalize(text).split():
+        position = lower.find(term)
+        if position >= 0:
+            break
+
+    start = max(position - width // 3, 0) if position >= 0 else 0
+    end = start + width
+    snippet = ' '.join(content[start:end].split())
+    if start > 0:
+        snippet = '…' + snippet
+    if end < len(content):
+        snippet += '…'
+    return snippet
+
+
+class SearchIndex(object):
+    """
+    聊天记录全文搜索，索引保存在单独的 SQLite 数据库中，与聊天记录使用哪种存储无关。
+
+    第一次搜索时在后台线程建立索引，之后通过 storage 的 listener 随消息的增删改增量更新，
+    建立索引期间的修改先记下来，建好后再补上。
+    使用 FTS5 的 bm25 排序；SQLite 没有 FTS5 时退化为逐条匹配。
+    系统消息和出错的回复不参与搜索。
+    """
+
+    # 匹配的消息很多时只对最新的这么多条按相关度排序，保证常见词的搜索也足够快
+    max_candidates = 2000
+
+    def __init__(self, storage, path=SEARCH_INDEX_DB):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.storage = storage
+        self.path = path
+        self._conn = self._connect()
+        self.fts = self._create_tables()
+        self.built = self._get_meta('signature') == self._signature()
+        # 正在后台建立索引时为线程对象，期间的修改记在 _changes 中
+        self._thread = None
+        self._changes = []
+        self._lock = threading.Lock()
+        storage.add_listener(self._storage_changed)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _create_tables(self):
+        with self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS docs (
+                    id INTEGER PRIMARY KEY,
+                    chat TEXT NOT NULL,
+                    uid TEXT NOT NULL UNIQUE,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS docs_chat ON docs (chat);
+            ''')
+            try:
+                self._conn.execute(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(grams, chars, words)')
+            except sqlite3.OperationalError:
+                return False
+        return True
+
+    def _signature(self):
+        # 切换存储方式后聊天记录可能不同，需要重建
+        return '{}:{}:{}'.format(INDEX_VERSION, int(self.fts), type(self.storage).__name__)
+
+    def _get_meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _indexed(message):
+        return (message.get('role') != 'system' and bool(message.get('id')) and
+                not message.get('failed'))
+
+    @staticmethod
+    def _terms(content):
+        return tuple(' '.join(terms) for terms in tokenize(content))
+
+    def _add(self, conn, chat_name, message):
+        """ 添加或者更新一条消息，不需要索引的消息会从索引中移除 """
+        if message.get('id'):
+            self._remove(conn, message['id'])
+        if not self._indexed(message):
+            return
+        cursor = conn.execute(
+            'INSERT INTO docs (chat, uid, role, content) VALUES (?, ?, ?, ?)',
+            (chat_name, message['id'], message['role'], message['content']))
+        if self.fts:
+            conn.execute(
+                'INSERT INTO docs_fts (rowid, grams, chars, words) VALUES (?, ?, ?, ?)',
+                (cursor.lastrowid,) + self._terms(message['content']))
+
+    def _remove(self, conn, message_id):
+        row = conn.execute('SELECT id FROM docs WHERE uid = ?', (message_id,)).fetchone()
+        if row is None:
+            return
+        conn.execute('DELETE FROM docs WHERE id = ?', row)
+        if self.fts:
+            conn.execute('DELETE FROM docs_fts WHERE rowid = ?', row)
+
+    def _rename_chat(self, conn, old_name, chat_name):
+        conn.execute('UPDATE docs SET chat = ? WHERE chat = ?', (chat_name, old_name))
+
+    def _remove_chat(self, conn, chat_name):
+        if self.fts:
+            conn.execute(
+                'DELETE FROM docs_fts WHERE rowid IN (SELECT id FROM docs WHERE chat = ?)',
+                (chat_name,))
+        conn.execute('DELETE FROM docs WHERE chat = ?', (chat_name,))
+
+    @staticmethod
+    def _change(storage, op, args, removed):
+        """ 把 storage 的操作转换成对索引的修改 (method, args)，消息复制一份，之后的修改不影响 """
+        if op in ('append', 'insert'):
+            return '_add', (args[0], dict(args[-1]))
+        if op in ('update', 'append_content', 'set_failed'):
+            chat_name, position = args[:2]
+            return '_add', (chat_name, dict(storage.get_messages(chat_name)[position]))
+        if op == 'pop':
+            if isinstance(removed, dict) and removed.get('id'):
+                return '_remove', (removed['id'],)
+        elif op == 'rename':
+            return '_rename_chat', args[:2]
+        elif op == 'delete_history':
+            return '_remove_chat', args[:1]
+        return None
+
+    def _storage_changed(self, storage, op, args, removed):
+        # 还没有建立索引时不需要更新，建立时会读取全部聊天记录
+        if not self.built and self._thread is None:
+            return
+        change = self._change(storage, op, args, removed)
+        if change is None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                self._changes.append(change)
+                return
+
+        try:
+            with self._conn:
+                method, change_args = change
+                getattr(self, method)(self._conn, *change_args)
+        except sqlite3.Error:
+            # 索引出错不影响聊天记录，下次搜索时重建
+            self.invalidate()
+
+    def invalidate(self):
+        self.built = False
+        with self._conn:
+            self._conn.execute('DELETE FROM meta WHERE key = ?', ('signature',))
+
+    def start_rebuild(self, finished=None):
+        """
+        在后台线程重建索引，结束后（失败时 built 仍为 False）在后台线程调用 finished()，
+        界面需要通过信号转回界面线程。已经在重建时直接返回，不会调用这次传入的 finished。
+        """
+        if self._thread is not None:
+            return
+        # 在调用线程取得聊天记录，之后的修改记在 _changes 中。
+        # 取得时可能会落盘并通知 listener，不能持有锁
+        reader = self.storage.messages_reader()
+        with self._lock:
+            self.built = False
+            self._changes = []
+            self._thread = threading.Thread(
+                target=self._rebuild, args=(reader, finished), daemon=True)
+            self._thread.start()
+
+    def rebuild(self):
+        """ 重建索引并等待完成 """
+        self.start_rebuild()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _rebuild(self, reader, finished):
+        conn = self._connect()
+        try:
+            self._build(conn, reader())
+        except Exception:
+            # 保持未建立的状态，下次搜索时重试
+            with self._lock:
+                self._thread = None
+        finally:
+            conn.close()
+        if finished is not None:
+            finished()
+
+    def _build(self, conn, messages):
+        docs = []
+        terms = []
+        seen = set()
+        for chat_name, message in messages:
+            if not self._indexed(message) or message['id'] in seen:
+                continue
+            seen.add(message['id'])
+            docs.append((len(docs) + 1, chat_name, message['id'], message['role'],
+                         message['content']))
+            if self.fts:
+                terms.append((len(docs),) + self._terms(message['content']))
+
+        with conn:
+            conn.execute('DELETE FROM docs')
+            conn.executemany(
+                'INSERT INTO docs (id, chat, uid, role, content) VALUES (?, ?, ?, ?, ?)', docs)
+            if self.fts:
+                conn.execute('DELETE FROM docs_fts')
+                conn.executemany(
+                    'INSERT INTO docs_fts (rowid, grams, chars, words) VALUES (?, ?, ?, ?)', terms)
+
+        # 补上建立索引期间的修改，处理完之前新的修改继续记下来
+        while True:
+            with self._lock:
+                changes, self._changes = self._changes, []
+                if not changes:
+                    with conn:
+                        conn.execute(
+                            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                            ('signature', self._signature()))
+                    self.built = True
+                    self._thread = None
+                    return
+            with conn:
+                for method, args in changes:
+                    getattr(self, method)(conn, *args)
+
+    def _query(self, text, limit):
+        if self.fts:
+            query = build_query(text)
+            if not query:
+                return []
+            # 不排序时按 rowid 倒序读取很快，先找出第 max_candidates 条匹配的 rowid
+            row = self._conn.execute(
+                'SELECT rowid FROM docs_fts WHERE docs_fts MATCH ? '
+                'ORDER BY rowid DESC LIMIT 1 OFFSET ?',
+                (query, self.max_candidates - 1)).fetchone()
+            return self._conn.execute('''
+                SELECT docs.chat, docs.uid, docs.role, docs.content, bm25(docs_fts) AS score
+                FROM docs_fts JOIN docs ON docs.id = docs_fts.rowid
+                WHERE docs_fts MATCH ? AND docs_fts.rowid >= ? ORDER BY score LIMIT ?
+            ''', (query, row[0] if row else 0, limit)).fetchall()
+
+        terms = normalize(text).split()
+        return self._conn.execute('''
+            SELECT chat, uid, role, content, 0 FROM docs
+            WHERE {} ORDER BY id DESC LIMIT ?
+        '''.format(' AND '.join(['instr(lower(content), ?) > 0'] * len(terms))),
+            terms + [limit]).fetchall()
+
+    def search(self, text, limit=50):
+        """
+        按相关度排序的搜索结果，
+        [{'chat_name', 'message_id', 'position', 'role', 'snippet', 'score'}]，
+        position 不包含系统消息，与 get_messages_range 一致。
+        """
+        if not text.strip():
+            return []
+        if not self.built:
+            self.rebuild()
+
+        hits = []
+        stale = []
+        for chat_name, message_id, role, content, score in self._query(text, limit):
+            position = self.storage.get_message_position(chat_name, message_id)
+            if position is None:
+                # 聊天记录中已经没有这条消息
+                stale.append(message_id)
+                continue
+            hits.append({
+                'chat_name': chat_name,
+                'message_id': message_id,
+                'position': position,
+                'role': role,
+                'snippet': make_snippet(content, text),
+                'score': score,
+            })
+
+        if stale:
+            with self._conn:
+                for message_id in stale:
+                    self._remove(self._conn, message_id)
+        return hits
+
+    def close(self):
+        self.storage.remove_listener(self._storage_changed)
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        self._conn.close()
+
+
+_search_index = None
+
+
+def get_search_index():
+    """ 第一次调用时开始监听聊天记录的修改 """
+    global _search_index
+
+    if _search_index is None:
+        _search_index = SearchIndex(chat_history_storage)
+    return _search_index
@@ -0,0 +1,22 @@
+from PySide2 import QtCore
+
+
+class SignalBus(QtCore.QObject):
+    """ 全局事件总线，单独放在这里，托盘启动时导入不需要加载控件和图标库 """
+
+    history_item_changed = QtCore.Signal(dict)
+    # 聊天改名，(old_name, chat_name)，聊天记录中已经改好
+    history_renamed = QtCore.Signal(str, str)
+    config_saved = QtCore.Signal()
+    message_copied = QtCore.Signal(str)
+    # 搜索结果跳转，{'chat_name', 'message_id', 'position', ...}
+    message_located = QtCore.Signal(dict)
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(SignalBus, cls).__new__(cls, *args, **kwargs)
+
+        return cls._instance
+
+
+signal_bus = SignalBus()
@@ -0,0 +1,875 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from anywhere.utils import (
+    CHAT_HISTORY, CHAT_HISTORY_SNAPSHOT, CHAT_HISTORY_LOG, CHAT_HISTORY_DB, get_config)
+
+
+def new_message_id():
+    return uuid4().hex
+
+
+class ChatHistoryStorage(object):
+    """
+    聊天记录存储，所有修改都会整体重写 ChatHistory.json
+
+    每条消息都有一个持久的 id，界面通过 id 操作消息，不受系统消息和删除造成的下标变化影响。
+    """
+
+    def __init__(self):
+        self._storage = self._get_history()
+        # 流式输出时只改内存、尚未落盘的消息，{(chat_name, index): 已落盘的内容长度}，
+        # 内容被整体替换过时为 None
+        self._pending = {}
+        # 已经检查过消息都有 id 的聊天
+        self._id_checked = set()
+        # {chat_name: {message_id: index}}，下标变化后在查询时自动重建
+        self._id_index = {}
+        # 每次落盘的修改（包括 flush 写入的流式输出内容）之后调用 listener(storage, op, args, removed)
+        self._listeners = []
+
+    @staticmethod
+    def _get_history():
+        if not os.path.exists(CHAT_HISTORY):
+            return {}
+
+        with open(CHAT_HISTORY) as f:
+            data = json.loads(f.read())
+            return data
+
+    def _save_history(self):
+        if not os.path.exists(os.path.dirname(CHAT_HISTORY)):
+            os.makedirs(os.path.dirname(CHAT_HISTORY))
+        with open(CHAT_HISTORY, 'w') as f:
+            f.write(json.dumps(self._storage, indent=2))
+
+    # 所有修改都拆成下面这些确定性的操作，方便日志存储按操作记录和回放
+    @staticmethod
+    def _op_append(storage, chat_name, message):
+        storage[chat_name].setdefault('messages', []).append(message)
+
+    @staticmethod
+    def _op_insert(storage, chat_name, index, message):
+        storage[chat_name].setdefault('messages', []).insert(index, message)
+
+    @staticmethod
+    def _op_pop(storage, chat_name, index):
+        storage[chat_name]['messages'].pop(index)
+
+    @staticmethod
+    def _op_update(storage, chat_name, index, content):
+        message = storage[chat_name]['messages'][index]
+        message['content'] = content
+        message.pop('failed', None)
+
+    @staticmethod
+    def _op_set_failed(storage, chat_name, index, content):
+        message = storage[chat_name]['messages'][index]
+        message['content'] = content
+        message['failed'] = True
+
+    @staticmethod
+    def _op_append_content(storage, chat_name, index, content):
+        storage[chat_name]['messages'][index]['content'] += content
+
+    @staticmethod
+    def _op_set_ids(storage, chat_name, ids):
+        for message, message_id in zip(storage[chat_name]['messages'], ids):
+            if isinstance(message, dict) and message_id:
+                message['id'] = message_id
+
+    @staticmethod
+    def _op_set_common(storage, chat_name, config):
+        storage.setdefault(chat_name, {}).setdefault('common', {}).update(config)
+
+    @staticmethod
+    def _op_rename(storage, old_name, chat_name, config):
+        data = storage.pop(old_name)
+        if config:
+            data.get('common', {}).update(config)
+        storage[chat_name] = data
+
+    @staticmethod
+    def _op_delete_history(storage, chat_name):
+        storage.pop(chat_name, None)
+
+    @classmethod
+    def _apply(cls, storage, op, args):
+        getattr(cls, '_op_{}'.format(op))(storage, *args)
+
+    def _execute(self, op, *args):
+        # 先落盘暂存的内容，保证操作顺序和下标都与内存一致
+        self.flush()
+        # 删除的消息在操作之后就拿不到了，先记下来，落盘时按它的 id 删除，也通知给 listener
+        removed = None
+        if op == 'pop':
+            removed = self._storage[args[0]]['messages'][args[1]]
+        self._apply(self._storage, op, args)
+        self._persist(op, args, removed)
+
+        if op in ('rename', 'delete_history'):
+            self._forget_ids(args[0])
+        for listener in self._listeners:
+            listener(self, op, args, removed)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _persist(self, op, args, removed=None):
+        self._save_history()
+
+    def _chat(self, chat_name):
+        chat = self._storage[chat_name]
+        self._ensure_ids(chat_name, chat)
+        return chat
+
+    def _ensure_ids(self, chat_name, chat):
+        """ 旧版本保存的消息没有 id，第一次读取时补上并保存 """
+        if chat_name in self._id_checked:
+            return
+        self._id_checked.add(chat_name)
+
+        messages = chat.get('messages', [])
+        if all(isinstance(m, dict) and m.get('id') for m in messages):
+            return
+        ids = [
+            (m.get('id') or new_message_id()) if isinstance(m, dict) else None
+            for m in messages
+        ]
+        self._apply(self._storage, 'set_ids', (chat_name, ids))
+        self._persist('set_ids', (chat_name, ids))
+
+    def _forget_ids(self, chat_name):
+        self._id_checked.discard(chat_name)
+        self._id_index.pop(chat_name, None)
+
+    def _position(self, chat_name, message_id):
+        """ 消息 id 在 messages 中的下标（包含系统消息），不存在时返回 None """
+        if chat_name not in self._storage:
+            return None
+
+        messages = self._chat(chat_name).get('messages', [])
+        index = self._id_index.get(chat_name)
+        position = index.get(message_id) if index is not None else None
+        if (position is None or position >= len(messages) or
+                not isinstance(messages[position], dict) or
+                messages[position].get('id') != message_id):
+            index = self._id_index[chat_name] = {
+                m['id']: i for i, m in enumerate(messages) if isinstance(m, dict)
+            }
+            position = index.get(message_id)
+        return position
+
+    def _has_system_message(self, chat_name):
+        messages = self._chat(chat_name).get('messages')
+        return bool(messages) and messages[0]['role'] == 'system'
+
+    def get_messages(self, chat_name):
+        if chat_name not in self._storage:
+            return []
+        return self._chat(chat_name).get('messages', [])
+
+    def count_messages(self, chat_name):
+        """ 不包含系统消息的消息条数 """
+        if chat_name not in self._storage:
+            return 0
+        count = len(self._chat(chat_name).get('messages', []))
+        return count - 1 if self._has_system_message(chat_name) else count
+
+    def get_messages_range(self, chat_name, start, end):
+        """ 返回下标在 [start, end) 的消息，下标不包含系统消息，与 get_message_position 一致 """
+        if chat_name not in self._storage:
+            return []
+        offset = 1 if self._has_system_message(chat_name) else 0
+        return self._chat(chat_name).get('messages', [])[start + offset:end + offset]
+
+    def append_messages(self, chat_name, message):
+        """ 返回消息的 id """
+        message = dict(message)
+        message.setdefault('id', new_message_id())
+        self._execute('append', chat_name, message)
+
+        index = self._id_index.get(chat_name)
+        if index is not None:
+            index[message['id']] = len(self._chat(chat_name)['messages']) - 1
+        return message['id']
+
+    def get_message_position(self, chat_name, message_id):
+        """ 消息的下标，不包含系统消息，与 get_messages_range 一致，不存在时返回 None """
+        position = self._position(chat_name, message_id)
+        if position is None:
+            return None
+        return position - 1 if self._has_system_message(chat_name) else position
+
+    def messages_reader(self, chat_name=None):
+        """
+        返回一个可以在后台线程调用的函数，调用时返回 chat_name（为 None 时是所有聊天）的
+        [(chat_name, message)]，包含调用 messages_reader 之前的所有修改。
+        """
+        names = self.get_history_names() if chat_name is None else [chat_name]
+        snapshot = [
+            (name, dict(message))
+            for name in names if name in self._storage
+            for message in self._chat(name).get('messages', [])
+            if isinstance(message, dict)
+        ]
+        return lambda: snapshot
+
+    def get_message_by_id(self, chat_name, message_id):
+        position = self._position(chat_name, message_id)
+        if position is None:
+            return None
+        return self._chat(chat_name)['messages'][position]
+
+    def get_messages_before(self, chat_name, message_id):
+        """ 这条消息之前的所有消息（包含系统消息），重新生成回复时作为上下文 """
+        position = self._position(chat_name, message_id)
+        if position is None:
+            return []
+        return self._chat(chat_name)['messages'][:position]
+
+    def delete_message_by_id(self, chat_name, message_id):
+        position = self._position(chat_name, message_id)
+        if position is not None:
+            self._execute('pop', chat_name, position)
+
+    def replace_message_by_id(self, chat_name, message_id, message, final=True):
+        """ final 为 False 时只更新内存，等 flush() 或最终结果到来时再落盘 """
+        position = self._position(chat_name, message_id)
+        if position is not None:
+            self._replace_at(chat_name, position, message, final)
+
+    def mark_message_failed(self, chat_name, message_id, content):
+        """
+        请求出错时把错误信息保存为这条回复的内容，并标记为失败，界面重新加载时仍然显示为出错，
+        可以重新生成。失败的消息不会作为上下文发送，也不参与 token 统计和搜索。
+        """
+        position = self._position(chat_name, message_id)
+        if position is not None:
+            self._pending.pop((chat_name, position), None)
+            self._execute('set_failed', chat_name, position, content)
+
+    def append_message_content_by_id(self, chat_name, message_id, content):
+        position = self._position(chat_name, message_id)
+        if position is not None:
+            self._append_content_at(chat_name, position, content)
+
+    def _replace_at(self, chat_name, position, message, final):
+        if not final:
+            self._apply(self._storage, 'update', (chat_name, position, message))
+            self._pending[(chat_name, position)] = None
+            return
+        self._pending.pop((chat_name, position), None)
+        self._execute('update', chat_name, position, message)
+
+    def _append_content_at(self, chat_name, position, content):
+        message = self._chat(chat_name)['messages'][position]
+        # 第一次追加时内存与磁盘一致，记下已落盘的长度，flush() 时只写新增的部分
+        self._pending.setdefault((chat_name, position), len(message['content']))
+        self._apply(self._storage, 'append_content', (chat_name, position, content))
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        changes = []
+        for (chat_name, index), flushed in pending.items():
+            content = self._storage[chat_name]['messages'][index]['content']
+            if flushed is None:
+                changes.append(('update', (chat_name, index, content)))
+            elif len(content) > flushed:
+                changes.append(('append_content', (chat_name, index, content[flushed:])))
+
+        for op, args in changes:
+            self._persist(op, args)
+        # 全部落盘后再通知，listener 看到的聊天记录与磁盘一致
+        for op, args in changes:
+            for listener in self._listeners:
+                listener(self, op, args, None)
+
+    def close(self):
+        self.flush()
+
+    def set_system_message(self, chat_name, message):
+        if not self._chat(chat_name).get('messages'):
+            self.append_messages(chat_name, {'role': 'system', 'content': message})
+        elif self._has_system_message(chat_name):
+            self._execute('update', chat_name, 0, message)
+        else:
+            self._execute('insert', chat_name, 0, {
+                'role': 'system', 'content': message, 'id': new_message_id()})
+
+    def delete_system_message(self, chat_name):
+        if 'messages' not in self._chat(chat_name):
+            return
+        if not self._has_system_message(chat_name):
+            return
+        self._execute('pop', chat_name, 0)
+
+    def get_common_config(self, chat_name):
+        return self._storage.get(chat_name, {}).get('common', {})
+
+    def set_common_config(self, chat_name, config):
+        self._execute('set_common', chat_name, config)
+
+    def change_common_config_name(self, old_name, chat_name, config=None):
+        # 先检查，避免内存中已经改名而落盘失败（或者覆盖掉同名的聊天）
+        if chat_name != old_name and chat_name in self._storage:
+            raise ValueError('聊天 {} 已存在'.format(chat_name))
+        self._execute('rename', old_name, chat_name, config)
+
+    def get_history_names(self):
+        return list(self._storage.keys())
+
+    def get_histories(self):
+        return self._storage
+
+    def get_history_index(self):
+        """ 聊天列表需要的轻量信息，{chat_name: {'common', 'updated_at'}}，不包含消息内容 """
+        return OrderedDict(
+            (name, {'common': data.get('common', {}), 'updated_at': None})
+            for name, data in self._storage.items()
+        )
+
+    def delete_history(self, chat_name):
+        self._execute('delete_history', chat_name)
+
+
+class ChatHistoryLogStorage(ChatHistoryStorage):
+    """
+    追加日志方式的聊天记录存储。
+
+    每次修改只在 ChatHistory.log 末尾追加一行紧凑的操作记录，启动时在快照的基础上回放日志；
+    日志超过 compact_threshold 后会切换到新的日志文件，并在后台线程里把旧日志合并进快照。
+    """
+
+    compact_threshold = 4 * 1024 * 1024
+
+    def __init__(self):
+        self._seq = 0
+        self._log_file = None
+        self._compact_thread = None
+        super().__init__()
+
+        if os.path.exists(self._old_log_path()):
+            # 上次合并没有完成（比如中途退出），重新合并一次
+            self._start_compact(self._seq)
+
+    @staticmethod
+    def _old_log_path():
+        return '{}.old'.format(CHAT_HISTORY_LOG)
+
+    @classmethod
+    def _load_snapshot(cls):
+        if os.path.exists(CHAT_HISTORY_SNAPSHOT):
+            with open(CHAT_HISTORY_SNAPSHOT, encoding='utf-8') as f:
+                data = json.loads(f.read())
+                return data['seq'], data['histories']
+
+        # 还没有快照时以旧版的 ChatHistory.json 为基础
+        return 0, ChatHistoryStorage._get_history()
+
+    @classmethod
+    def _replay(cls, storage, path, since_seq, until_seq=None):
+        last_seq = since_seq
+        if not os.path.exists(path):
+            return last_seq
+
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    seq, op, args = json.loads(line)
+                except ValueError:
+                    # 写到一半被中断的最后一行
+                    continue
+
+                if seq <= since_seq or (until_seq is not None and seq > until_seq):
+                    continue
+                last_seq = max(last_seq, seq)
+                try:
+                    cls._apply(storage, op, args)
+                except (KeyError, IndexError, TypeError):
+                    continue
+        return last_seq
+
+    @classmethod
+    def load_histories(cls):
+        seq, storage = cls._load_snapshot()
+        seq = cls._replay(storage, cls._old_log_path(), seq)
+        return cls._replay(storage, CHAT_HISTORY_LOG, seq), storage
+
+    def _get_history(self):
+        self._seq, storage = self.load_histories()
+        return storage
+
+    def _open_log(self):
+        if self._log_file is None:
+            if not os.path.exists(os.path.dirname(CHAT_HISTORY_LOG)):
+                os.makedirs(os.path.dirname(CHAT_HISTORY_LOG))
+            self._log_file = open(CHAT_HISTORY_LOG, 'a', encoding='utf-8', newline='\n')
+        return self._log_file
+
+    def _persist(self, op, args, removed=None):
+        self._seq += 1
+        log_file = self._open_log()
+        log_file.write(json.dumps(
+            [self._seq, op, args], ensure_ascii=False, separators=(',', ':')))
+        log_file.write('\n')
+        log_file.flush()
+
+        if log_file.tell() > self.compact_threshold:
+            self.compact()
+
+    def _save_history(self):
+        # 日志存储不会整体重写文件
+        pass
+
+    def compact(self):
+        if self._compact_thread and self._compact_thread.is_alive():
+            return
+        if os.path.exists(self._old_log_path()):
+            return
+
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+        if os.path.exists(CHAT_HISTORY_LOG):
+            os.replace(CHAT_HISTORY_LOG, self._old_log_path())
+        self._start_compact(self._seq)
+
+    def _start_compact(self, seq):
+        self._compact_thread = threading.Thread(
+            target=self._compact, args=(seq,), daemon=True)
+        self._compact_thread.start()
+
+    @classmethod
+    def _compact(cls, until_seq):
+        # 在独立的数据上合并，不触碰界面线程正在使用的 self._storage
+        seq, storage = cls._load_snapshot()
+        seq = cls._replay(storage, cls._old_log_path(), seq, until_seq)
+
+        tmp_path = '{}.tmp'.format(CHAT_HISTORY_SNAPSHOT)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(
+                {'seq': seq, 'histories': storage},
+                ensure_ascii=False, separators=(',', ':')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, CHAT_HISTORY_SNAPSHOT)
+        os.remove(cls._old_log_path())
+
+    def close(self):
+        super().close()
+        if self._compact_thread and self._compact_thread.is_alive():
+            self._compact_thread.join()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
+class ChatHistorySQLiteStorage(ChatHistoryStorage):
+    """
+    SQLite 方式的聊天记录存储。
+
+    每条消息一行，按 (chat_id, position) 建索引。position 只是排序用的键，相邻消息之间留有间隔，
+    增删改都只涉及一行。启动时只读取聊天列表和公共配置，打开某个聊天时才读取它的消息，
+    最近使用的 max_loaded_chats 个聊天的消息保留在内存中。
+    首次使用时会自动导入已有的日志存储或 ChatHistory.json 中的聊天记录。
+    """
+
+    max_loaded_chats = 16
+    position_gap = 1024
+    # PRAGMA user_version，表示已经导入过旧的聊天记录
+    migrated_version = 1
+    _message_ops = ('append', 'insert', 'pop', 'update', 'set_failed')
+
+    def __init__(self, path=CHAT_HISTORY_DB):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._loaded = OrderedDict()
+        self._unloading = False
+        super().__init__()
+
+    def _create_tables(self):
+        with self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS chats (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE,
+                    common TEXT NOT NULL DEFAULT '{}',
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    uid TEXT,
+                    failed INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS messages_chat_position
+                    ON messages (chat_id, position);
+            ''')
+
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(messages)')]
+            if 'uid' not in columns:
+                self._conn.execute('ALTER TABLE messages ADD COLUMN uid TEXT')
+            if 'failed' not in columns:
+                self._conn.execute(
+                    'ALTER TABLE messages ADD COLUMN failed INTEGER NOT NULL DEFAULT 0')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS messages_uid ON messages (uid)')
+
+    def _get_history(self):
+        self._create_tables()
+        # 不能以 chats 是否为空来判断，否则删除最后一个聊天后下次启动又会导入旧的聊天记录
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] < self.migrated_version:
+            self._migrate()
+
+        return OrderedDict(
+            (name, {'common': json.loads(common)})
+            for name, common in self._conn.execute(
+                'SELECT name, common FROM chats ORDER BY id')
+        )
+
+    def _migrate(self):
+        # 没有记录 user_version 的旧版本数据库里已经有聊天时说明导入过了
+        if not self._conn.execute('SELECT 1 FROM chats LIMIT 1').fetchone():
+            if (os.path.exists(CHAT_HISTORY_SNAPSHOT) or
+                    os.path.exists(CHAT_HISTORY_LOG)):
+                _, histories = ChatHistoryLogStorage.load_histories()
+            else:
+                histories = ChatHistoryStorage._get_history()
+            self._insert_histories(histories)
+        self._conn.execute('PRAGMA user_version = {}'.format(self.migrated_version))
+
+    def import_histories(self, histories):
+        """ 导入 {chat_name: {'common': {}, 'messages': []}} 格式的聊天记录，不能与已有的聊天重名 """
+        self._insert_histories(histories)
+        # 和启动时一样只记下公共配置，消息在使用时才加载
+        for name, data in histories.items():
+            self._storage[name] = {'common': dict(data.get('common', {}))}
+
+    def _insert_histories(self, histories):
+        now = time.time()
+        with self._conn:
+            for name, data in histories.items():
+                cursor = self._conn.execute(
+                    'INSERT INTO chats (name, common, updated_at) VALUES (?, ?, ?)',
+                    (name, json.dumps(data.get('common', {}), ensure_ascii=False), now))
+                self._conn.executemany(
+                    'INSERT INTO messages (chat_id, position, role, content, uid, failed) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [
+                        (cursor.lastrowid, position * self.position_gap,
+                         message['role'], message['content'],
+                         message.get('id') or new_message_id(), int(bool(message.get('failed'))))
+                        for position, message in enumerate(
+                            m for m in data.get('messages', []) if isinstance(m, dict))
+                    ])
+
+    @staticmethod
+    def _message_row(role, content, uid, failed):
+        message = {'role': role, 'content': content}
+        if uid:
+            message['id'] = uid
+        if failed:
+            message['failed'] = True
+        return message
+
+    def _chat(self, chat_name):
+        chat = self._storage[chat_name]
+        if 'messages' not in chat:
+            chat['messages'] = [
+                self._message_row(*row)
+                for row in self._conn.execute(
+                    'SELECT role, content, uid, failed FROM messages '
+                    'WHERE chat_id = (SELECT id FROM chats WHERE name = ?) '
+                    'ORDER BY position', (chat_name,))
+            ]
+            self._forget_ids(chat_name)
+        self._ensure_ids(chat_name, chat)
+
+        self._loaded[chat_name] = True
+        self._loaded.move_to_end(chat_name)
+        self._unload_chats(chat_name)
+        return chat
+
+    def _unload_chats(self, keep):
+        """ 释放最久没有使用的聊天，直到不超过 max_loaded_chats，keep 是正在使用的聊天 """
+        # flush 时 listener 可能会读取聊天，再次进入这里，只由最外层负责释放
+        if self._unloading:
+            return
+        self._unloading = True
+        try:
+            while len(self._loaded) > max(self.max_loaded_chats, 1):
+                name = next(name for name in self._loaded if name != keep)
+                if any(key[0] == name for key in self._pending):
+                    # 落盘后 listener 可能读取过这个聊天，重新选择要释放的聊天
+                    self.flush()
+                    continue
+                self._loaded.pop(name)
+                self._storage[name].pop('messages', None)
+                self._forget_ids(name)
+        finally:
+            self._unloading = False
+
+    def _is_loaded(self, chat_name):
+        return 'messages' in self._storage.get(chat_name, {})
+
+    def count_messages(self, chat_name):
+        # 已经加载的聊天以内存为准，里面可能有还没落盘的流式输出内容
+        if chat_name not in self._storage or self._is_loaded(chat_name):
+            return super().count_messages(chat_name)
+
+        count, = self._conn.execute(
+            'SELECT COUNT(*) FROM messages '
+            'WHERE chat_id = (SELECT id FROM chats WHERE name = ?)', (chat_name,)).fetchone()
+        return count - self._sql_has_system_message(chat_name)
+
+    def _sql_has_system_message(self, chat_name):
+        row = self._conn.execute(
+            'SELECT role FROM messages WHERE chat_id = (SELECT id FROM chats WHERE name = ?) '
+            'ORDER BY position LIMIT 1', (chat_name,)).fetchone()
+        return row is not None and row[0] == 'system'
+
+    def get_messages_range(self, chat_name, start, end):
+        """ 没有加载的聊天直接按顺序分页查询，不读取整个聊天 """
+        if chat_name not in self._storage or self._is_loaded(chat_name):
+            return super().get_messages_range(chat_name, start, end)
+
+        offset = 1 if self._sql_has_system_message(chat_name) else 0
+        messages = [
+            self._message_row(*row)
+            for row in self._conn.execute(
+                'SELECT role, content, uid, failed FROM messages '
+                'WHERE chat_id = (SELECT id FROM chats WHERE name = ?) '
+                'ORDER BY position LIMIT ? OFFSET ?',
+                (chat_name, max(end - start, 0), start + offset))
+        ]
+        if not all('id' in m for m in messages):
+            # 旧数据还没有 id，加载整个聊天时会补上
+            return super().get_messages_range(chat_name, start, end)
+        return messages
+
+    def get_message_position(self, chat_name, message_id):
+        if chat_name not in self._storage or self._is_loaded(chat_name):
+            return super().get_message_position(chat_name, message_id)
+
+        row = self._conn.execute('''
+            SELECT (
+                SELECT COUNT(*) FROM messages AS earlier
+                WHERE earlier.chat_id = messages.chat_id AND earlier.position < messages.position)
+            FROM messages
+            WHERE uid = ? AND chat_id = (SELECT id FROM chats WHERE name = ?)
+        ''', (message_id, chat_name)).fetchone()
+        if row is None:
+            return None
+        return row[0] - self._sql_has_system_message(chat_name)
+
+    def messages_reader(self, chat_name=None):
+        """ 先把暂存的内容落盘，返回的函数使用单独的连接读取，不需要在界面线程加载聊天 """
+        self.flush()
+        # 旧数据没有 id 的聊天先加载一次补上 id
+        for (name,) in self._conn.execute('''
+            SELECT DISTINCT chats.name FROM messages
+            JOIN chats ON chats.id = messages.chat_id
+            WHERE messages.uid IS NULL AND (? IS NULL OR chats.name = ?)
+        ''', (chat_name, chat_name)).fetchall():
+            self._chat(name)
+
+        path = self.path
+
+        def read():
+            conn = sqlite3.connect(path)
+            try:
+                return [
+                    (name, ChatHistorySQLiteStorage._message_row(*row))
+                    for name, *row in conn.execute('''
+                        SELECT chats.name, messages.role, messages.content, messages.uid,
+                            messages.failed
+                        FROM messages JOIN chats ON chats.id = messages.chat_id
+                        WHERE ? IS NULL OR chats.name = ?
+                        ORDER BY chats.id, messages.position
+                    ''', (chat_name, chat_name))
+                ]
+            finally:
+                conn.close()
+        return read
+
+    def _execute(self, op, *args):
+        if op in self._message_ops:
+            self._chat(args[0])
+        super()._execute(op, *args)
+
+        if op == 'rename':
+            self._loaded.pop(args[0], None)
+        elif op == 'delete_history':
+            self._loaded.pop(args[0], None)
+
+    def _persist(self, op, args, removed=None):
+        with self._conn:
+            if op == 'pop':
+                self._sql_pop(args[0], removed)
+            else:
+                getattr(self, '_sql_{}'.format(op))(*args)
+
+    def _save_history(self):
+        pass
+
+    def _touch(self, chat_name):
+        self._conn.execute(
+            'UPDATE chats SET updated_at = ? WHERE name = ?', (time.time(), chat_name))
+
+    def _insert_row(self, chat_name, position, message):
+        self._conn.execute(
+            'INSERT INTO messages (chat_id, position, role, content, uid, failed) '
+            'VALUES ((SELECT id FROM chats WHERE name = ?), ?, ?, ?, ?, ?)',
+            (chat_name, position, message['role'], message['content'], message.get('id'),
+             int(bool(message.get('failed')))))
+        self._touch(chat_name)
+
+    def _sql_append(self, chat_name, message):
+        row = self._conn.execute(
+            'SELECT MAX(position) FROM messages '
+            'WHERE chat_id = (SELECT id FROM chats WHERE name = ?)', (chat_name,)).fetchone()
+        position = 0 if row[0] is None else row[0] + self.position_gap
+        self._insert_row(chat_name, position, message)
+
+    def _uid_at(self, chat_name, index):
+        """ 内存中第 index 条消息的 id，落盘时内存已经应用了这次操作 """
+        return self._storage[chat_name]['messages'][index]['id']
+
+    def _sql_position(self, chat_name, uid):
+        row = self._conn.execute(
+            'SELECT position FROM messages '
+            'WHERE uid = ? AND chat_id = (SELECT id FROM chats WHERE name = ?)',
+            (uid, chat_name)).fetchone()
+        return row[0] if row else None
+
+    def _sql_insert(self, chat_name, index, message):
+        # 插入到内存中前后两条消息之间
+        messages = self._storage[chat_name]['messages']
+        before = self._sql_position(chat_name, messages[index - 1]['id']) if index > 0 else None
+        after = (self._sql_position(chat_name, messages[index + 1]['id'])
+                 if index + 1 < len(messages) else None)
+        if after is None:
+            return self._sql_append(chat_name, message)
+        if before is None:
+            position = after - self.position_gap
+        elif after - before > 1:
+            position = (before + after) // 2
+        else:
+            # 间隔用完时重新编号，正常使用中几乎不会发生
+            self._renumber(chat_name)
+            return self._sql_insert(chat_name, index, message)
+        self._insert_row(chat_name, position, message)
+
+    def _renumber(self, chat_name):
+        rows = self._conn.execute(
+            'SELECT id FROM messages WHERE chat_id = (SELECT id FROM chats WHERE name = ?) '
+            'ORDER BY position', (chat_name,)).fetchall()
+        self._conn.executemany(
+            'UPDATE messages SET position = ? WHERE id = ?',
+            [(index * self.position_gap, row_id) for index, (row_id,) in enumerate(rows)])
+
+    def _sql_pop(self, chat_name, message):
+        self._conn.execute(
+            'DELETE FROM messages WHERE uid = ? AND chat_id = (SELECT id FROM chats WHERE name = ?)',
+            (message['id'], chat_name))
+        self._touch(chat_name)
+
+    def _update_row(self, chat_name, index, assignments, params):
+        """ 按 id 更新第 index 条消息，通过 messages_uid 索引找到这一行，不需要按顺序扫描 """
+        self._conn.execute(
+            'UPDATE messages SET {} '
+            'WHERE uid = ? AND chat_id = (SELECT id FROM chats WHERE name = ?)'.format(assignments),
+            params + (self._uid_at(chat_name, index), chat_name))
+        self._touch(chat_name)
+
+    def _sql_update(self, chat_name, index, content):
+        self._update_row(chat_name, index, 'content = ?, failed = 0', (content,))
+
+    def _sql_set_failed(self, chat_name, index, content):
+        self._update_row(chat_name, index, 'content = ?, failed = 1', (content,))
+
+    def _sql_append_content(self, chat_name, index, content):
+        self._update_row(chat_name, index, 'content = content || ?', (content,))
+
+    def _sql_set_ids(self, chat_name, ids):
+        rows = self._conn.execute(
+            'SELECT id FROM messages WHERE chat_id = (SELECT id FROM chats WHERE name = ?) '
+            'ORDER BY position', (chat_name,)).fetchall()
+        self._conn.executemany(
+            'UPDATE messages SET uid = ? WHERE id = ?',
+            [(uid, row_id) for (row_id,), uid in zip(rows, ids) if uid])
+
+    def _sql_set_common(self, chat_name, config):
+        common = json.dumps(self._storage[chat_name]['common'], ensure_ascii=False)
+        self._conn.execute(
+            'INSERT OR IGNORE INTO chats (name, common, updated_at) VALUES (?, ?, ?)',
+            (chat_name, common, time.time()))
+        self._conn.execute(
+            'UPDATE chats SET common = ? WHERE name = ?', (common, chat_name))
+
+    def _sql_rename(self, old_name, chat_name, config):
+        self._conn.execute(
+            'UPDATE chats SET name = ?, common = ? WHERE name = ?',
+            (chat_name,
+             json.dumps(self._storage[chat_name].get('common', {}), ensure_ascii=False),
+             old_name))
+
+    def _sql_delete_history(self, chat_name):
+        self._conn.execute(
+            'DELETE FROM messages WHERE chat_id = (SELECT id FROM chats WHERE name = ?)',
+            (chat_name,))
+        self._conn.execute('DELETE FROM chats WHERE name = ?', (chat_name,))
+
+    def get_histories(self):
+        """ 只保证包含每个聊天的 common，messages 请通过 get_messages 获取 """
+        return self._storage
+
+    def get_history_index(self):
+        # 只读 chats 表，不扫描消息；更新时间以数据库为准，先把流式输出暂存的内容落盘
+        self.flush()
+        return OrderedDict(
+            (name, {'common': json.loads(common), 'updated_at': updated_at})
+            for name, common, updated_at in self._conn.execute(
+                'SELECT name, common, updated_at FROM chats ORDER BY id')
+        )
+
+    def close(self):
+        super().close()
+        self._conn.close()
+
+
+STORAGE_BACKENDS = {
+    'json': ChatHistoryStorage,
+    'log': ChatHistoryLogStorage,
+    'sqlite': ChatHistorySQLiteStorage,
+}
+
+
+def create_chat_history_storage():
+    # 默认使用 SQLite，启动时只读取聊天列表，和聊天记录的总量无关
+    backend = get_config('common').get('history_storage', 'sqlite')
+    return STORAGE_BACKENDS.get(backend, ChatHistorySQLiteStorage)()
+
+
+chat_history_storage = create_chat_history_storage()
+atexit.register(chat_history_storage.close)
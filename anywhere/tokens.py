@@ -0,0 +1,142 @@
+import re
+import threading
+from collections import OrderedDict
+
+CJK_RE = re.compile(r'[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]')
+
+# 每条消息除内容外的固定开销，参考 OpenAI 的计算方式
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+CONTEXT_POLICIES = ('all', 'window', 'summary')
+
+
+class TokenCounter(object):
+    """
+    统计消息的 token 数。
+
+    安装了 tiktoken 时使用对应的编码，否则按字符估算（中日韩字符每个算一个 token，其余每 4 个字符算一个）。
+    结果按文本缓存，同一条消息只计算一次。
+    """
+
+    def __init__(self, encoding_name='cl100k_base', max_items=8192):
+        self.encoding_name = encoding_name
+        self.max_items = max_items
+        # None 表示还没有加载，False 表示 tiktoken 不可用
+        self._encoding = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load_encoding(self):
+        # tiktoken 导入和加载编码都比较慢，第一次统计时才加载
+        try:
+            import tiktoken
+            return tiktoken.get_encoding(self.encoding_name)
+        except Exception:
+            return False
+
+    def _encode_count(self, text):
+        if self._encoding is None:
+            self._encoding = self._load_encoding()
+        if self._encoding:
+            return len(self._encoding.encode(text, disallowed_special=()))
+
+        cjk = len(CJK_RE.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def count_text(self, text):
+        with self._lock:
+            count = self._cache.get(text)
+            if count is not None:
+                self._cache.move_to_end(text)
+                return count
+
+        count = self._encode_count(text)
+        with self._lock:
+            self._cache[text] = count
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+        return count
+
+    def count_message(self, message):
+        return MESSAGE_OVERHEAD + self.count_text(message['content'])
+
+    def count_messages(self, messages):
+        if not messages:
+            return 0
+        return sum(self.count_message(m) for m in messages) + REPLY_OVERHEAD
+
+
+token_counter = TokenCounter()
+
+
+def summarize_messages(messages, max_tokens, counter=token_counter):
+    """ 本地摘要：每条消息只保留开头的一部分，直到用完 token 预算 """
+    lines = []
+    used = 0
+    for message in messages:
+        name = '用户' if message['role'] == 'user' else '助手'
+        text = ' '.join(message['content'].split())[:120]
+        line = '{}：{}'.format(name, text)
+        cost = counter.count_text(line)
+        if used + cost > max_tokens:
+            break
+        lines.append(line)
+        used += cost
+    return '\n'.join(lines)
+
+
+def trim_messages(messages, policy='all', max_tokens=3000, keep_system=True,
+                  counter=token_counter):
+    """
+    按上下文策略裁剪要发送的消息。
+
+    all：全部发送；window：从最新的一轮对话往前保留，直到达到 max_tokens；
+    summary：与 window 相同，但被丢弃的早期消息会压缩成一条摘要放在最前面。
+    按整轮（一条用户消息和它后面的回复）保留，不会只留下回复而丢掉对应的提问。
+    keep_system 为 True 时始终保留系统提示词，最新的一轮也总会保留。
+    """
+    if policy not in ('window', 'summary') or not messages:
+        return messages
+
+    system = []
+    if keep_system and messages[0]['role'] == 'system':
+        system = messages[:1]
+    rest = messages[len(system):]
+
+    budget = max_tokens - counter.count_messages(system)
+    summary_budget = budget // 4 if policy == 'summary' else 0
+    budget -= summary_budget
+
+    turns = []
+    for message in rest:
+        if turns and message['role'] == 'assistant':
+            turns[-1].append(message)
+        else:
+            turns.append([message])
+
+    kept = []
+    total = 0
+    for turn in reversed(turns):
+        cost = sum(counter.count_message(m) for m in turn)
+        if kept and total + cost > budget:
+            break
+        kept[:0] = turn
+        total += cost
+
+    dropped = rest[:len(rest) - len(kept)]
+    if summary_budget and dropped:
+        summary = summarize_messages(dropped, summary_budget, counter)
+        if summary:
+            system = system + [
+                {'role': 'system', 'content': '以下是之前对话的摘要：\n{}'.format(summary)}]
+    return system + kept
+
+
+def trim_messages_by_config(messages, config):
+    return trim_messages(
+        messages,
+        config.get('context_policy', 'all'),
+        config.get('context_max_tokens', 3000),
+        config.get('context_keep_system', True),
+    )
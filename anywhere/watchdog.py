@@ -0,0 +1,191 @@
+"""
+界面卡顿检测。
+
+界面线程上的定时器不断更新心跳时间，后台线程检查心跳；超过阈值没有更新时说明事件循环被阻塞，
+这时通过 sys._current_frames() 抓取界面线程的 Python 调用栈，按调用位置统计卡顿次数和时长。
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from PySide2 import QtCore
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StallWatchdog(QtCore.QObject):
+    # 卡顿时间超过这个值（秒）的视为电脑休眠等原因，不统计
+    max_stall = 30
+
+    def __init__(self, threshold=0.05, interval=0.02, log=False, parent=None):
+        super().__init__(parent)
+        # 阻塞超过 threshold 秒视为卡顿
+        self.threshold = threshold
+        # 心跳间隔
+        self.interval = interval
+        # 后台线程检查心跳和抓取调用栈的间隔
+        self.poll_interval = min(threshold / 4, 0.01)
+        self.sample_interval = threshold / 2
+        self.log = log
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self._timer.setInterval(int(interval * 1000))
+        self._timer.timeout.connect(self._beat)
+
+        self._beat_time = None
+        self._main_ident = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        # {site: {'count', 'total', 'max', 'stack'}}
+        self._sites = {}
+        self.stalls = 0
+        # 事件循环延迟：心跳实际触发时间比预期晚了多少
+        self._lag_count = 0
+        self._lag_total = 0
+        self._lag_max = 0
+
+    def start(self):
+        """ 需要在界面线程、事件循环开始之后调用，否则启动阶段会被误判为卡顿 """
+        self._main_ident = threading.get_ident()
+        self._beat_time = time.perf_counter()
+        self._stop.clear()
+        self._timer.start()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._timer.stop()
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _beat(self):
+        now = time.perf_counter()
+        lag = max(now - self._beat_time - self.interval, 0)
+        self._lag_count += 1
+        self._lag_total += lag
+        self._lag_max = max(self._lag_max, lag)
+        self._beat_time = now
+
+    def _watch(self):
+        stall_beat = None
+        samples = []
+        last_sample = 0
+        while not self._stop.wait(self.poll_interval):
+            beat = self._beat_time
+            now = time.perf_counter()
+
+            if stall_beat is not None and beat != stall_beat:
+                # 心跳恢复，这次卡顿结束
+                self._record(beat - stall_beat - self.interval, samples)
+                stall_beat = None
+                samples = []
+
+            if now - beat - self.interval < self.threshold:
+                continue
+            if stall_beat is None:
+                stall_beat = beat
+                last_sample = 0
+            if now - last_sample >= self.sample_interval:
+                stack = self._sample()
+                if stack:
+                    samples.append(stack)
+                last_sample = now
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._main_ident)
+        if frame is None:
+            return None
+        return traceback.extract_stack(frame)
+
+    @staticmethod
+    def _site(stack):
+        """ 调用栈中最内层属于本项目的位置，没有的话用最内层的位置 """
+        for frame in reversed(stack):
+            path = os.path.abspath(frame.filename)
+            if path.startswith(PACKAGE_DIR) and path != os.path.abspath(__file__):
+                return '{} ({}:{})'.format(
+                    frame.name, os.path.relpath(path, os.path.dirname(PACKAGE_DIR)),
+                    frame.lineno)
+        frame = stack[-1]
+        return '{} ({}:{})'.format(frame.name, os.path.basename(frame.filename), frame.lineno)
+
+    def _record(self, duration, samples):
+        if duration < self.threshold or duration > self.max_stall:
+            return
+
+        # 多次采样时以出现最多的位置为准
+        sites = [(self._site(stack), stack) for stack in samples]
+        if sites:
+            site = Counter(s for s, _ in sites).most_common(1)[0][0]
+            stack = next(stack for s, stack in sites if s == site)
+            stack_text = ''.join(traceback.format_list(stack))
+        else:
+            site = '未知'
+            stack_text = ''
+
+        with self._lock:
+            self.stalls += 1
+            data = self._sites.setdefault(site, {'count': 0, 'total': 0, 'max': 0, 'stack': ''})
+            data['count'] += 1
+            data['total'] += duration
+            if duration >= data['max']:
+                data['max'] = duration
+                data['stack'] = stack_text
+
+        if self.log:
+            print('[stall] {:.0f} ms: {}'.format(duration * 1000, site), file=sys.stderr)
+
+    def report(self):
+        """ 按总卡顿时长从大到小排列的调用位置，时间单位为秒 """
+        with self._lock:
+            sites = [dict(data, site=site) for site, data in self._sites.items()]
+        return sorted(sites, key=lambda data: data['total'], reverse=True)
+
+    def stats(self):
+        return {
+            'stalls': self.stalls,
+            'threshold': self.threshold,
+            'loop_lag_mean': self._lag_total / self._lag_count if self._lag_count else 0,
+            'loop_lag_max': self._lag_max,
+        }
+
+    def format_report(self, limit=10):
+        lines = ['卡顿 {} 次，事件循环最大延迟 {:.0f} ms'.format(
+            self.stalls, self._lag_max * 1000)]
+        for data in self.report()[:limit]:
+            lines.append('{:>5} 次 {:>8.0f} ms  最长 {:>6.0f} ms  {}'.format(
+                data['count'], data['total'] * 1000, data['max'] * 1000, data['site']))
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._sites.clear()
+            self.stalls = 0
+        self._lag_count = 0
+        self._lag_total = 0
+        self._lag_max = 0
+
+
+_watchdog = None
+
+
+def start_stall_watchdog(threshold=0.05, log=False, parent=None):
+    global _watchdog
+
+    if _watchdog is None:
+        _watchdog = StallWatchdog(threshold, log=log, parent=parent)
+        _watchdog.start()
+    return _watchdog
+
+
+def get_stall_watchdog():
+    """ 没有开启卡顿检测时返回 None """
+    return _watchdog
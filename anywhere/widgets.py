@@ -5,6 +5,7 @@ from PySide2 import QtSvg
 
 import qtawesome
 from anywhere.utils import RESOURCES_PATH
+from anywhere.signals import SignalBus, signal_bus
 
 
 def show_message(message, message_type='success', parent=None):
@@ -18,23 +19,6 @@ def show_question(question, parent=None):
     return response == QtWidgets.QMessageBox.Yes
 
 
-class SignalBus(QtCore.QObject):
-    """ 全局事件总线 """
-
-    history_item_changed = QtCore.Signal(dict)
-    config_saved = QtCore.Signal()
-    message_copied = QtCore.Signal(str)
-
-    def __new__(cls, *args, **kwargs):
-        if not hasattr(cls, '_instance'):
-            cls._instance = super(SignalBus, cls).__new__(cls, *args, **kwargs)
-
-        return cls._instance
-
-
-signal_bus = SignalBus()
-
-
 def create_h_spacer_item():
     return QtWidgets.QSpacerItem(
         0, 0, QtWidgets.QSizePolicy.Expanding,
@@ -0,0 +1,372 @@
+"""
+聊天流程的性能基准测试，不依赖真实的界面和网络。
+
+    QT_QPA_PLATFORM=offscreen python -m tests.benchmark --output result.json
+    QT_QPA_PLATFORM=offscreen python -m tests.benchmark --compare baseline.json
+
+测试在临时目录中进行，不会读写 ~/Anywhere 下的真实数据。
+文件名不以 test_ 开头，不会被 pytest 收集。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+WORDS = [
+    '模型', '接口', '缓存', '线程', '渲染', '消息', '配置', '性能', '数据库', '队列',
+    'request', 'stream', 'token', 'widget', 'layout', 'python', 'cache', 'latency',
+]
+
+CODE_SAMPLE = '''def fibonacci(n):
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+'''
+
+
+def seeded_id(rng):
+    """ 由 rng 生成的消息 id，格式与 new_message_id 相同，同一个种子每次都一样 """
+    return uuid.UUID(int=rng.getrandbits(128)).hex
+
+
+def generate_message(rng, role, size=400):
+    """
+    生成一条大约 size 个字符的消息，回复中混合段落、列表和代码块。
+    消息带有 id，和正常保存的聊天记录一样，不会测到给旧数据补 id 的过程。
+    """
+    parts = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if role == 'assistant' and kind < 0.15:
+            block = '```python\n{}```'.format(CODE_SAMPLE)
+        elif role == 'assistant' and kind < 0.35:
+            block = '\n'.join(
+                '- {}'.format(' '.join(rng.choice(WORDS) for _ in range(6)))
+                for _ in range(rng.randint(2, 5)))
+        else:
+            block = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 40)))
+        parts.append(block)
+        length += len(block)
+    return {'role': role, 'content': '\n\n'.join(parts), 'id': seeded_id(rng)}
+
+
+def generate_history(chats, messages_per_chat, seed=0, size=400):
+    """ {chat_name: {'common': {}, 'messages': []}}，和聊天记录的存储格式相同 """
+    rng = random.Random(seed)
+    histories = {}
+    for chat in range(chats):
+        messages = [
+            {'role': 'system', 'content': '你是一个乐于助人的助手。', 'id': seeded_id(rng)}]
+        for index in range(messages_per_chat):
+            role = 'user' if index % 2 == 0 else 'assistant'
+            length = size if role == 'assistant' else size // 4
+            messages.append(generate_message(rng, role, length))
+        histories['聊天{}'.format(chat)] = {
+            'common': {'role': '', 'description': '', 'temperature': 0.6},
+            'messages': messages,
+        }
+    return histories
+
+
+def summarize(samples):
+    """ 毫秒 """
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p95_ms': samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def _remove_history_files():
+    from anywhere.utils import (
+        CHAT_HISTORY, CHAT_HISTORY_SNAPSHOT, CHAT_HISTORY_LOG)
+    for path in (CHAT_HISTORY, CHAT_HISTORY_SNAPSHOT, CHAT_HISTORY_LOG):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def bench_history_load(sizes, workdir):
+    """ 不同总消息数下各个存储后端的启动耗时和打开一个聊天的耗时 """
+    from anywhere.utils import CHAT_HISTORY, CHAT_HISTORY_SNAPSHOT
+    from anywhere.storage import (
+        ChatHistoryStorage, ChatHistoryLogStorage, ChatHistorySQLiteStorage)
+
+    results = {}
+    for total in sizes:
+        chats = max(total // 200, 1)
+        histories = generate_history(chats, total // chats)
+        name = next(iter(histories))
+
+        # 先导入数据库，否则新建的数据库会自动从下面写入的文件迁移一份
+        _remove_history_files()
+        db_path = '{}/bench_{}.db'.format(workdir, total)
+        storage = ChatHistorySQLiteStorage(db_path)
+        storage.import_histories(histories)
+        storage.close()
+        with open(CHAT_HISTORY, 'w') as f:
+            f.write(json.dumps(histories, indent=2))
+        with open(CHAT_HISTORY_SNAPSHOT, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'seq': 0, 'histories': histories}, ensure_ascii=False))
+
+        backends = {
+            'json': ChatHistoryStorage,
+            'log': ChatHistoryLogStorage,
+            'sqlite': lambda: ChatHistorySQLiteStorage(db_path),
+        }
+        for backend, factory in backends.items():
+            start = time.perf_counter()
+            storage = factory()
+            storage.get_history_index()
+            loaded = time.perf_counter()
+            storage.get_messages_range(name, 0, storage.count_messages(name))
+            opened = time.perf_counter()
+            storage.close()
+            results['{}_{}'.format(backend, total)] = {
+                'messages': total,
+                'startup_ms': (loaded - start) * 1000,
+                'open_chat_ms': (opened - loaded) * 1000,
+            }
+        _remove_history_files()
+    return results
+
+
+def bench_markdown(count=200):
+    from anywhere.markdown_convert import convert_markdown, render_markdown, render_cache
+
+    rng = random.Random(1)
+    texts = [generate_message(rng, 'assistant', 1500)['content'] for _ in range(count)]
+    total_chars = sum(len(text) for text in texts)
+
+    render_cache.clear()
+    start = time.perf_counter()
+    for text in texts:
+        convert_markdown(text, cache=False)
+    uncached = time.perf_counter() - start
+
+    for text in texts:
+        render_markdown(text)
+    start = time.perf_counter()
+    for text in texts:
+        render_markdown(text)
+    cached = time.perf_counter() - start
+
+    return {
+        'documents': count,
+        'docs_per_sec': count / uncached,
+        'chars_per_sec': total_chars / uncached,
+        'cached_docs_per_sec': count / max(cached, 1e-9),
+    }
+
+
+def bench_streaming(app, chunks=400, chunk_size=12):
+    """ 流式输出时每个增量的耗时，包括追加到消息和同步重绘 """
+    from anywhere.chat.chat_content_widget import ChatContentWidget
+
+    rng = random.Random(2)
+    text = generate_message(rng, 'assistant', chunks * chunk_size)['content']
+    pieces = [text[i:i + chunk_size] for i in range(0, chunks * chunk_size, chunk_size)]
+
+    widget = ChatContentWidget()
+    widget.resize(800, 600)
+    widget.show()
+    for index in range(20):
+        widget.add_message('user' if index % 2 == 0 else 'bot',
+                           generate_message(rng, 'assistant', 300)['content'])
+    item = widget.add_message('bot', '')
+    app.processEvents()
+
+    samples = []
+    for piece in pieces:
+        start = time.perf_counter()
+        widget.append_text(item, piece)
+        widget.viewport().repaint()
+        samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    widget.set_text(item, ''.join(item.chunks))
+    widget.viewport().repaint()
+    finish = time.perf_counter() - start
+
+    widget.close()
+    widget.deleteLater()
+    app.processEvents()
+
+    result = summarize(samples)
+    result['finish_ms'] = finish * 1000
+    return result
+
+
+def bench_chat_switch(app, sizes, repeat=5):
+    """ ChatWidget.history_item_changed 切换到不同长度聊天的耗时，包括第一次绘制 """
+    from anywhere.storage import chat_history_storage
+    from anywhere.chat.chat_content_widget import ChatWidget
+
+    histories = {}
+    for size in sizes:
+        history = generate_history(1, size, seed=size)
+        histories['切换{}'.format(size)] = next(iter(history.values()))
+    if hasattr(chat_history_storage, 'import_histories'):
+        chat_history_storage.import_histories(histories)
+    else:
+        for name, data in histories.items():
+            chat_history_storage.set_common_config(name, data['common'])
+            for message in data['messages']:
+                chat_history_storage.append_messages(name, message)
+
+    widget = ChatWidget()
+    widget.resize(900, 700)
+    widget.show()
+    app.processEvents()
+
+    results = {}
+    names = list(histories)
+    for name in names:
+        samples = []
+        for _ in range(repeat):
+            # 先切换到其他聊天，避免测到的只是重复设置同一个聊天
+            other = names[(names.index(name) + 1) % len(names)]
+            widget.history_item_changed(
+                {'name': other, 'data': chat_history_storage.get_common_config(other)})
+            app.processEvents()
+
+            start = time.perf_counter()
+            widget.history_item_changed(
+                {'name': name, 'data': chat_history_storage.get_common_config(name)})
+            widget.content_widget.viewport().repaint()
+            samples.append(time.perf_counter() - start)
+            app.processEvents()
+        results['messages_{}'.format(len(histories[name]['messages']) - 1)] = summarize(samples)
+
+    widget.close()
+    widget.deleteLater()
+    app.processEvents()
+    return results
+
+
+def flatten(data, prefix=''):
+    items = {}
+    for key, value in data.items():
+        name = '{}.{}'.format(prefix, key) if prefix else key
+        if isinstance(value, dict):
+            items.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            items[name] = value
+    return items
+
+
+# 参与比较的指标，per_sec 越大越好，耗时和内存越小越好
+METRIC_SUFFIXES = ('_ms', '_mb', 'per_sec')
+HIGHER_IS_BETTER = ('per_sec',)
+
+
+def compare(results, baseline, threshold):
+    """ 打印和基准结果的差异，返回变差超过 threshold 的指标 """
+    current = flatten(results['results'])
+    previous = flatten(baseline['results'])
+    regressions = []
+    for name in sorted(current):
+        if not name.endswith(METRIC_SUFFIXES) or not previous.get(name):
+            continue
+
+        change = (current[name] - previous[name]) / previous[name]
+        if any(name.endswith(suffix) for suffix in HIGHER_IS_BETTER):
+            change = -change
+        flag = ''
+        if change > threshold:
+            flag = '  <-- 变慢'
+            regressions.append(name)
+        print('{:<60} {:>12.2f} {:>12.2f} {:>+8.1%}{}'.format(
+            name, previous[name], current[name], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Anywhere 聊天流程性能基准测试')
+    parser.add_argument('--output', help='把结果写入这个 JSON 文件')
+    parser.add_argument('--compare', help='和这个 JSON 文件中的结果比较')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='比较时超过这个比例的变差视为性能回退，默认 0.1')
+    parser.add_argument('--sizes', default='1000,5000,20000',
+                        help='聊天记录加载测试的总消息数，逗号分隔')
+    parser.add_argument('--quick', action='store_true', help='使用更小的数据量快速运行')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.quick:
+        sizes = [200, 1000]
+
+    # 必须在导入 anywhere 之前切换用户目录，所有数据都写到临时目录里
+    workdir = tempfile.mkdtemp(prefix='anywhere_benchmark_')
+    os.environ['HOME'] = workdir
+    os.environ['USERPROFILE'] = workdir
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    os.makedirs('{}/Anywhere'.format(workdir))
+
+    try:
+        from PySide2 import QtWidgets, __version__ as pyside_version
+        app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+        results = {
+            'history_load': bench_history_load(sizes, workdir),
+            'markdown': bench_markdown(50 if args.quick else 200),
+            'streaming': bench_streaming(app, 100 if args.quick else 400),
+            'chat_switch': bench_chat_switch(
+                app, [50, 500] if args.quick else [50, 500, 5000],
+                2 if args.quick else 5),
+        }
+        results['memory'] = {'peak_rss_mb': peak_rss_mb()}
+
+        from anywhere.storage import chat_history_storage
+        chat_history_storage.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    data = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pyside2': pyside_version,
+        },
+        'results': results,
+    }
+    text = json.dumps(data, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(data, json.load(f), args.threshold)
+        if regressions:
+            print('性能回退：{}'.format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
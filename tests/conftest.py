@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+import pytest
+
+# anywhere.utils 在导入时根据用户目录确定配置路径，测试中换成临时目录，不读写真实数据
+_home = tempfile.mkdtemp(prefix='anywhere-test-')
+os.environ['HOME'] = _home
+os.environ['USERPROFILE'] = _home
+
+from anywhere import storage  # noqa: E402
+
+BACKENDS = ['json', 'log', 'sqlite']
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    """ 使用这个参数的测试对每种存储各运行一次 """
+    return request.param
+
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    for name, filename in [
+        ('CHAT_HISTORY', 'ChatHistory.json'),
+        ('CHAT_HISTORY_SNAPSHOT', 'ChatHistory.snapshot.json'),
+        ('CHAT_HISTORY_LOG', 'ChatHistory.log'),
+        ('CHAT_HISTORY_DB', 'ChatHistory.db'),
+    ]:
+        monkeypatch.setattr(storage, name, str(tmp_path / filename))
+    return tmp_path
+
+
+@pytest.fixture
+def open_storage(paths):
+    """ open_storage(backend) 打开一个存储，测试结束时自动关闭，重复调用相当于重新启动 """
+    opened = []
+
+    def factory(backend):
+        if backend == 'sqlite':
+            instance = storage.ChatHistorySQLiteStorage(storage.CHAT_HISTORY_DB)
+        else:
+            instance = storage.STORAGE_BACKENDS[backend]()
+        opened.append(instance)
+        return instance
+
+    yield factory
+    for instance in opened:
+        try:
+            instance.close()
+        except Exception:
+            pass
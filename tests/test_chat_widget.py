@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('PySide2.QtWidgets')
+pytest.importorskip('qtawesome')
+
+
+@pytest.fixture
+def qapp():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def test_rename_chat_while_streaming(qapp, monkeypatch):
+    from anywhere.storage import chat_history_storage
+    from anywhere.chat.chat_history_widget import ChatHistoryWidget
+    from anywhere.chat.chat_content_widget import ChatWidget
+    from anywhere.chat.request_executor import get_request_scheduler
+
+    common = {'role': '', 'description': '', 'temperature': 0.6}
+    chat_history_storage.set_common_config('chat', common)
+    history_widget = ChatHistoryWidget()
+    chat_widget = ChatWidget()
+    history_widget.init_data()
+    chat_widget.history_item_changed({'name': 'chat', 'data': common})
+
+    # 不真正发出请求，输出由测试直接发送
+    scheduler = get_request_scheduler()
+    monkeypatch.setattr(scheduler.executor, 'submit', lambda request: None)
+    content_widget = chat_widget.content_widget
+    message_id = chat_history_storage.append_messages(
+        'chat', {'role': 'assistant', 'content': ''})
+    item = content_widget.add_message('bot', '思考中...', True, message_id)
+    request = content_widget.start_request(item, [], {'model': 'm', 'key': 'k'}, 0.6)
+
+    try:
+        request.show_message_signal.emit({'success': True, 'delta': 'Hello', 'final': False})
+        history_widget.new_chat_window_saved({
+            'name': 'renamed', 'old_name': 'chat', 'role': '', 'description': '',
+            'temperature': 0.6, 'prompt': 'system'})
+        request.show_message_signal.emit({'success': True, 'delta': ' world', 'final': False})
+        request.show_message_signal.emit(
+            {'success': True, 'message': 'Hello world', 'final': True})
+
+        assert request.chat_name == 'renamed'
+        assert chat_widget._history_data['name'] == 'renamed'
+        assert content_widget.chat_name == 'renamed'
+        assert item.current_text() == 'Hello world' and not item.busy
+        assert 'chat' not in chat_history_storage.get_history_names()
+        assert chat_history_storage.get_message_by_id(
+            'renamed', message_id)['content'] == 'Hello world'
+    finally:
+        chat_history_storage.delete_history('renamed')
+        chat_widget.deleteLater()
+        history_widget.deleteLater()
@@ -0,0 +1,89 @@
+import pytest
+import requests
+
+from anywhere.chat_client import ChatCompletionClient, ChatCompletionError
+from anywhere.fake_server import FakeChatServer, FakeServerConfig
+
+MESSAGES = [{'role': 'user', 'content': '你好'}]
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+    clients = []
+
+    def factory(**kwargs):
+        kwargs.setdefault('tokens_per_second', 0)
+        kwargs.setdefault('ttft', 0)
+        server = FakeChatServer(config=FakeServerConfig(**kwargs)).start()
+        servers.append(server)
+        client = ChatCompletionClient()
+        clients.append(client)
+        config = {'proxy': server.api_base, 'key': 'test', 'model': 'fake'}
+        return server, client, config
+
+    yield factory
+    for client in clients:
+        client.close()
+    for server in servers:
+        server.stop()
+
+
+def test_stream_through_chat_client(start_server):
+    server, client, config = start_server(reply_tokens=40, chunk_size=3)
+    expected = ''.join(server.reply_tokens({'messages': MESSAGES}))
+
+    # 同一个连接上连续请求两次，回复都完整
+    for _ in range(2):
+        with client.open_stream(config, MESSAGES, 0) as stream:
+            assert ''.join(stream) == expected
+    assert expected.startswith('收到：你好')
+
+
+def test_injected_error_and_drop(start_server):
+    server, client, config = start_server(error_rate=1)
+    with pytest.raises(ChatCompletionError, match='模拟错误 500'):
+        client.open_stream(config, MESSAGES, 0)
+
+    server, client, config = start_server(reply_tokens=40, drop_rate=1, seed=1)
+    expected = ''.join(server.reply_tokens({'messages': MESSAGES}))
+    received = []
+    # 没有收到结束标记就断开，读取时报错
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        with client.open_stream(config, MESSAGES, 0) as stream:
+            for delta in stream:
+                received.append(delta)
+    assert expected.startswith(''.join(received))
+    assert len(''.join(received)) < len(expected)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 50])
+def test_fault_rates_match_config(chunk_size):
+    config = FakeServerConfig(
+        reply_tokens=40, chunk_size=chunk_size, error_rate=0.1, drop_rate=0.2,
+        stall_rate=0.3, seed=7)
+    servers = [FakeChatServer(config=config) for _ in range(2)]
+    try:
+        plans = [servers[0].plan() for _ in range(5000)]
+        # 相同的种子得到相同的故障
+        assert [servers[1].plan() for _ in range(5000)] == plans
+    finally:
+        for server in servers:
+            server.server_close()
+
+    def rate(selected):
+        return sum(1 for plan in plans if selected(plan)) / len(plans)
+
+    assert rate(lambda plan: plan['error']) == pytest.approx(0.1, abs=0.02)
+    assert rate(lambda plan: plan['drop_at'] is not None) == pytest.approx(0.2, abs=0.02)
+    assert rate(lambda plan: plan['stall_at'] is not None) == pytest.approx(0.3, abs=0.02)
+
+    # 每个位置都是一个内容事件的开始，第一个事件之前也可能断开
+    starts = set(range(0, 40, chunk_size))
+    drops = {plan['drop_at'] for plan in plans if plan['drop_at'] is not None}
+    stalls = {plan['stall_at'] for plan in plans if plan['stall_at'] is not None}
+    assert drops <= starts and stalls <= starts
+    assert drops | stalls == starts
+    for plan in plans:
+        if plan['drop_at'] is not None and plan['stall_at'] is not None:
+            assert plan['stall_at'] <= plan['drop_at']
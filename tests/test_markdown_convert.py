@@ -0,0 +1,50 @@
+import pytest
+
+from anywhere.markdown_convert import IncrementalMarkdownRenderer, convert_markdown
+
+TEXTS = [
+    '1. one\n\n2. two\n\n3. three\n\nafter\n',
+    '- a\n\n    continued\n\n- b\n\ntext\n',
+    'para\n\n```python\nx = 1\n\ny = 2\n```\n\nend\n',
+    'first\n\nsecond\n\n1. x\n2. y\n\nlast\n',
+    '> quoted\n\n> still quoted\n\nafter\n',
+    '> a\n>\n> - b\n\n>     code\n\nend\n',
+    '[docs]: https://example.com "Docs"\n\nsee [the docs][docs]\n\nand [docs] again\n',
+    'intro\n\n[a]: http://a\n[B]: http://b\n\n[x][a] and [y][b]\n\n```\n[c]: http://c\n```\n\n[z][c]\n',
+]
+
+
+def stream(text, step):
+    renderer = IncrementalMarkdownRenderer()
+    blocks = []
+    for start in range(0, len(text), step):
+        blocks.extend(renderer.feed(text[start:start + step]))
+    return ''.join(blocks) + renderer.tail_html()
+
+
+def normalize(html):
+    return ''.join(html.split())
+
+
+@pytest.mark.parametrize('text', TEXTS)
+@pytest.mark.parametrize('step', [1, 5, 1000])
+def test_incremental_matches_full_render(text, step):
+    assert normalize(stream(text, step)) == normalize(convert_markdown(text, cache=False))
+
+
+def test_loose_ordered_list_is_not_split():
+    renderer = IncrementalMarkdownRenderer()
+    assert renderer.feed('1. one\n\n2. two\n\n') == []
+    assert normalize(renderer.tail_html()).count('<ol>') == 1
+
+
+def test_blockquote_is_not_split():
+    renderer = IncrementalMarkdownRenderer()
+    assert renderer.feed('> one\n\n> two\n\n') == []
+    assert normalize(renderer.tail_html()).count('<blockquote>') == 1
+
+
+def test_reference_definitions_apply_to_later_blocks():
+    renderer = IncrementalMarkdownRenderer()
+    blocks = renderer.feed('[ref]: https://example.com\n\nsee [here][ref]\n\nnext\n')
+    assert 'href="https://example.com"' in ''.join(blocks)
@@ -0,0 +1,75 @@
+import pytest
+
+from anywhere import response_cache
+from anywhere.response_cache import ResponseCache
+
+MESSAGES = [{'role': 'user', 'content': '你好'}]
+
+
+@pytest.fixture
+def open_cache(tmp_path):
+    opened = []
+
+    def factory(**kwargs):
+        cache = ResponseCache(str(tmp_path / 'cache' / 'ResponseCache.db'), **kwargs)
+        opened.append(cache)
+        return cache
+
+    yield factory
+    for cache in opened:
+        cache.close()
+
+
+def test_hit_and_miss(open_cache):
+    cache = open_cache()
+    key = cache.key('https://api.example.com/v1', 'model', MESSAGES, 0)
+    assert cache.get(key) is None
+
+    cache.put(key, '你好！')
+    assert cache.get(key) == '你好！'
+    assert cache.get(cache.key('https://api.example.com/v1', 'model', MESSAGES, 0.5)) is None
+
+
+def test_endpoint_is_part_of_key(open_cache):
+    cache = open_cache()
+    first = cache.key('https://api.example.com/v1', 'model', MESSAGES, 0)
+    second = cache.key('http://localhost:8000/v1', 'model', MESSAGES, 0)
+    assert first != second
+
+    cache.put(first, 'remote')
+    assert cache.get(second) is None
+    cache.put(second, 'local')
+    assert cache.get(first) == 'remote'
+
+
+def test_expired_entries_are_not_returned(open_cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, 'time', lambda: now[0])
+    cache = open_cache(ttl=60)
+    key = cache.key('endpoint', 'model', MESSAGES, 0)
+    cache.put(key, 'content')
+
+    now[0] += 59
+    assert cache.get(key) == 'content'
+    now[0] += 2
+    assert cache.get(key) is None
+
+
+def test_least_recently_used_entries_are_evicted(open_cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, 'time', lambda: now[0])
+    cache = open_cache(max_entries=2)
+    keys = [cache.key('endpoint', 'model', MESSAGES, index) for index in range(3)]
+
+    for index, key in enumerate(keys[:2]):
+        now[0] += 1
+        cache.put(key, str(index))
+    # 读取过的记录不会先被淘汰
+    now[0] += 1
+    assert cache.get(keys[0]) == '0'
+    now[0] += 1
+    cache.put(keys[2], '2')
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == '0'
+    assert cache.get(keys[2]) == '2'
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from anywhere import search
+
+
+@pytest.fixture
+def open_index(tmp_path):
+    opened = []
+
+    def factory(history):
+        index = search.SearchIndex(history, str(tmp_path / 'search' / 'SearchIndex.db'))
+        opened.append(index)
+        return index
+
+    yield factory
+    for index in opened:
+        index.close()
+
+
+def found(index, text):
+    return [hit['message_id'] for hit in index.search(text)]
+
+
+def test_search_finds_cjk_phrases_and_words(open_storage, open_index, backend):
+    history = open_storage(backend)
+    history.set_common_config('chat', {})
+    history.set_system_message('chat', '系统提示词')
+    first = history.append_messages('chat', {'role': 'user', 'content': '数据库连接池怎么配置'})
+    second = history.append_messages('chat', {'role': 'assistant', 'content': 'Use a Session'})
+
+    index = open_index(history)
+    assert found(index, '连接池') == [first]
+    assert found(index, 'sess') == [second]
+    assert found(index, '系统') == []
+    assert index.search('连接池')[0]['position'] == 0
+
+
+def test_flushed_stream_content_is_indexed(open_storage, open_index, backend):
+    history = open_storage(backend)
+    history.set_common_config('chat', {})
+    index = open_index(history)
+    index.rebuild()
+
+    message_id = history.append_messages('chat', {'role': 'assistant', 'content': ''})
+    history.append_message_content_by_id('chat', message_id, '流式输出的内容')
+    history.flush()
+    assert found(index, '流式') == [message_id]
+
+    history.mark_message_failed('chat', message_id, '请求出错')
+    assert found(index, '流式') == []
+    assert found(index, '出错') == []
+
+
+def test_changes_during_background_rebuild_are_applied(open_storage, open_index, monkeypatch):
+    history = open_storage('sqlite')
+    history.set_common_config('chat', {})
+    removed = history.append_messages('chat', {'role': 'user', 'content': 'removed'})
+    kept = history.append_messages('chat', {'role': 'user', 'content': 'kept'})
+    index = open_index(history)
+
+    # 让后台线程停在读取聊天记录之前，这时修改聊天记录
+    release = threading.Event()
+    messages_reader = history.messages_reader
+
+    def slow_reader(chat_name=None):
+        reader = messages_reader(chat_name)
+
+        def read():
+            release.wait(5)
+            return reader()
+        return read
+
+    monkeypatch.setattr(history, 'messages_reader', slow_reader)
+    done = threading.Event()
+    index.start_rebuild(done.set)
+    assert not index.built
+
+    history.delete_message_by_id('chat', removed)
+    added = history.append_messages('chat', {'role': 'user', 'content': 'added'})
+    history.change_common_config_name('chat', 'renamed')
+    release.set()
+    assert done.wait(5) and index.built
+
+    assert found(index, 'removed') == []
+    assert found(index, 'added') == [added]
+    assert [(hit['chat_name'], hit['message_id']) for hit in index.search('kept')] == [
+        ('renamed', kept)]
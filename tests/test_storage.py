@@ -0,0 +1,310 @@
+import sqlite3
+import threading
+
+import pytest
+
+from anywhere import storage
+
+
+def reopen(open_storage, instance, backend):
+    instance.close()
+    return open_storage(backend)
+
+
+def contents(instance, chat_name):
+    return [m['content'] for m in instance.get_messages(chat_name)]
+
+
+def test_streamed_content_survives_restart(open_storage, backend):
+    history = open_storage(backend)
+    history.set_common_config('chat', {})
+    message_id = history.append_messages('chat', {'role': 'assistant', 'content': ''})
+    for index in range(30):
+        history.append_message_content_by_id('chat', message_id, str(index % 10))
+        if index % 7 == 0:
+            history.flush()
+    history.replace_message_by_id('chat', message_id, 'new', final=False)
+    history.append_message_content_by_id('chat', message_id, '!')
+    history.flush()
+    history.append_message_content_by_id('chat', message_id, '?')
+
+    history = reopen(open_storage, history, backend)
+    assert contents(history, 'chat') == ['new!?']
+
+
+def test_log_flush_writes_only_new_content(open_storage):
+    history = open_storage('log')
+    history.set_common_config('chat', {})
+    message_id = history.append_messages('chat', {'role': 'assistant', 'content': ''})
+    for _ in range(100):
+        history.append_message_content_by_id('chat', message_id, 'x' * 100)
+        history.flush()
+    history.close()
+
+    with open(storage.CHAT_HISTORY_LOG, encoding='utf-8') as f:
+        size = len(f.read())
+    # 每次只记录新增的 100 个字符，而不是截至目前的全部内容
+    assert size < 100 * 100 * 2
+
+
+def test_basic_operations_survive_restart(open_storage, backend):
+    history = open_storage(backend)
+    history.set_common_config('chat', {'description': 'first'})
+    first = history.append_messages('chat', {'role': 'user', 'content': 'q1'})
+    second = history.append_messages('chat', {'role': 'assistant', 'content': 'a1'})
+    history.append_messages('chat', {'role': 'user', 'content': 'q2'})
+    history.set_system_message('chat', 'system')
+    history.replace_message_by_id('chat', second, 'a1!')
+    history.delete_message_by_id('chat', first)
+    history.set_common_config('other', {})
+    history.append_messages('other', {'role': 'user', 'content': 'x'})
+    history.change_common_config_name('chat', 'renamed', {'description': 'second'})
+    history.delete_history('other')
+
+    history = reopen(open_storage, history, backend)
+    assert history.get_history_names() == ['renamed']
+    assert history.get_common_config('renamed') == {'description': 'second'}
+    assert contents(history, 'renamed') == ['system', 'a1!', 'q2']
+    assert history.count_messages('renamed') == 2
+    assert history.get_message_position('renamed', second) == 0
+    assert [m['id'] for m in history.get_messages_range('renamed', 0, 1)] == [second]
+
+
+def test_rename_to_existing_name_changes_nothing(open_storage, backend):
+    history = open_storage(backend)
+    history.set_common_config('a', {})
+    history.append_messages('a', {'role': 'user', 'content': 'in a'})
+    history.set_common_config('b', {})
+    history.append_messages('b', {'role': 'user', 'content': 'in b'})
+
+    with pytest.raises(ValueError):
+        history.change_common_config_name('a', 'b')
+
+    history = reopen(open_storage, history, backend)
+    assert history.get_history_names() == ['a', 'b']
+    assert contents(history, 'a') == ['in a']
+    assert contents(history, 'b') == ['in b']
+
+
+def test_failed_message_survives_restart_until_regenerated(open_storage, backend):
+    history = open_storage(backend)
+    history.set_common_config('chat', {})
+    history.append_messages('chat', {'role': 'user', 'content': 'question'})
+    message_id = history.append_messages('chat', {'role': 'assistant', 'content': ''})
+    history.append_message_content_by_id('chat', message_id, 'partial')
+    history.mark_message_failed('chat', message_id, 'error')
+
+    history = reopen(open_storage, history, backend)
+    message = history.get_message_by_id('chat', message_id)
+    assert message['content'] == 'error' and message['failed']
+
+    # 重新生成时先清空内容，失败标记随之去掉
+    history.replace_message_by_id('chat', message_id, '', final=False)
+    history.append_message_content_by_id('chat', message_id, 'answer')
+    history.flush()
+
+    history = reopen(open_storage, history, backend)
+    assert history.get_messages('chat')[-1] == {
+        'role': 'assistant', 'content': 'answer', 'id': message_id}
+
+
+def test_log_compaction_and_replay(open_storage, monkeypatch):
+    monkeypatch.setattr(storage.ChatHistoryLogStorage, 'compact_threshold', 2000)
+    history = open_storage('log')
+    history.set_common_config('chat', {})
+    ids = []
+    for index in range(100):
+        ids.append(history.append_messages(
+            'chat', {'role': 'user', 'content': 'message {}'.format(index)}))
+        if history._compact_thread:
+            history._compact_thread.join()
+    history.delete_message_by_id('chat', ids[0])
+    history.close()
+
+    assert storage.os.path.exists(storage.CHAT_HISTORY_SNAPSHOT)
+    history = open_storage('log')
+    assert contents(history, 'chat') == ['message {}'.format(i) for i in range(1, 100)]
+
+
+def write_legacy_json(histories):
+    with open(storage.CHAT_HISTORY, 'w') as f:
+        f.write(storage.json.dumps(histories))
+
+
+def test_sqlite_migrates_legacy_json_once(open_storage):
+    write_legacy_json({'old': {'common': {}, 'messages': [{'role': 'user', 'content': 'hi'}]}})
+
+    history = open_storage('sqlite')
+    assert contents(history, 'old') == ['hi']
+    history.delete_history('old')
+
+    # 删除最后一个聊天后重新启动，不能再次导入旧的聊天记录
+    history = reopen(open_storage, history, 'sqlite')
+    assert history.get_history_names() == []
+
+
+def test_sqlite_migrates_legacy_log(open_storage):
+    log_history = open_storage('log')
+    log_history.set_common_config('old', {})
+    log_history.append_messages('old', {'role': 'user', 'content': 'from log'})
+    log_history.close()
+
+    history = open_storage('sqlite')
+    assert contents(history, 'old') == ['from log']
+
+
+def test_sqlite_database_from_older_version_is_not_migrated_again(open_storage):
+    history = open_storage('sqlite')
+    history.set_common_config('kept', {})
+    # 模拟旧版本创建的数据库：已经导入过，但没有记录 user_version
+    history._conn.execute('PRAGMA user_version = 0')
+    history.close()
+    write_legacy_json({'old': {'common': {}, 'messages': []}})
+
+    history = open_storage('sqlite')
+    assert history.get_history_names() == ['kept']
+
+
+def test_sqlite_edits_touch_only_affected_rows(open_storage):
+    history = open_storage('sqlite')
+    history.set_common_config('chat', {})
+    ids = [
+        history.append_messages('chat', {'role': 'user', 'content': str(index)})
+        for index in range(5)
+    ]
+
+    def positions():
+        return dict(history._conn.execute('SELECT uid, position FROM messages'))
+
+    before = positions()
+    history.delete_message_by_id('chat', ids[1])
+    history.set_system_message('chat', 'system')
+    history.replace_message_by_id('chat', ids[3], 'changed')
+    after = positions()
+    for message_id in ids[:1] + ids[2:]:
+        assert after[message_id] == before[message_id]
+
+    history = reopen(open_storage, history, 'sqlite')
+    assert contents(history, 'chat') == ['system', '0', '2', 'changed', '4']
+    assert history.count_messages('chat') == 4
+    assert history.get_message_position('chat', ids[3]) == 2
+
+
+def test_sqlite_imported_histories_are_usable_without_restart(open_storage):
+    history = open_storage('sqlite')
+    history.import_histories({'chat': {
+        'common': {'temperature': 0.6},
+        'messages': [
+            {'role': 'system', 'content': 'system', 'id': 's'},
+            {'role': 'user', 'content': 'hello', 'id': 'u'},
+        ],
+    }})
+    assert history.get_history_names() == ['chat']
+    assert history.get_common_config('chat') == {'temperature': 0.6}
+    assert history.count_messages('chat') == 1
+    assert history.get_message_position('chat', 'u') == 0
+    assert contents(history, 'chat') == ['system', 'hello']
+
+
+def test_sqlite_unloaded_chat_reads(open_storage):
+    history = open_storage('sqlite')
+    history.set_common_config('chat', {})
+    history.set_system_message('chat', 'system')
+    ids = [
+        history.append_messages('chat', {'role': 'user', 'content': str(index)})
+        for index in range(10)
+    ]
+    history.delete_message_by_id('chat', ids[4])
+
+    history = reopen(open_storage, history, 'sqlite')
+    assert not history._is_loaded('chat')
+    assert history.count_messages('chat') == 9
+    assert [m['content'] for m in history.get_messages_range('chat', 3, 6)] == ['3', '5', '6']
+    assert history.get_message_position('chat', ids[5]) == 4
+    assert not history._is_loaded('chat')
+
+
+def test_messages_reader_runs_in_another_thread(open_storage, backend):
+    history = open_storage(backend)
+    for chat_name in ('a', 'b'):
+        history.set_common_config(chat_name, {})
+        history.append_messages(chat_name, {'role': 'user', 'content': chat_name})
+    message_id = history.append_messages('a', {'role': 'assistant', 'content': ''})
+    history.append_message_content_by_id('a', message_id, 'streamed')
+
+    reader = history.messages_reader('a')
+    everything = history.messages_reader()
+
+    results = {}
+    thread = threading.Thread(
+        target=lambda: results.update(chat=reader(), all=everything()))
+    thread.start()
+    thread.join()
+    assert [(name, m['content']) for name, m in results['chat']] == [
+        ('a', 'a'), ('a', 'streamed')]
+    assert [name for name, _ in results['all']] == ['a', 'a', 'b']
+    assert all(m.get('id') for _, m in results['all'])
+
+
+def test_sqlite_messages_reader_does_not_load_chat(open_storage):
+    history = open_storage('sqlite')
+    history.set_common_config('chat', {})
+    history.append_messages('chat', {'role': 'user', 'content': 'hello'})
+
+    history = reopen(open_storage, history, 'sqlite')
+    assert [m['content'] for _, m in history.messages_reader('chat')()] == ['hello']
+    assert not history._is_loaded('chat')
+
+
+def test_sqlite_adds_failed_column_to_older_database(open_storage):
+    history = open_storage('sqlite')
+    history.set_common_config('chat', {})
+    history.append_messages('chat', {'role': 'user', 'content': 'hello'})
+    history.close()
+
+    conn = sqlite3.connect(storage.CHAT_HISTORY_DB)
+    with conn:
+        conn.execute('ALTER TABLE messages DROP COLUMN failed')
+    conn.close()
+
+    history = open_storage('sqlite')
+    message_id = history.append_messages('chat', {'role': 'assistant', 'content': ''})
+    history.mark_message_failed('chat', message_id, 'error')
+    history = reopen(open_storage, history, 'sqlite')
+    assert [m.get('failed', False) for m in history.get_messages('chat')] == [False, True]
+
+
+def test_sqlite_listener_sees_flush_when_chat_is_evicted(open_storage, monkeypatch):
+    monkeypatch.setattr(storage.ChatHistorySQLiteStorage, 'max_loaded_chats', 1)
+    history = open_storage('sqlite')
+    for chat_name in ('a', 'b'):
+        history.set_common_config(chat_name, {})
+        history.append_messages(chat_name, {'role': 'user', 'content': chat_name})
+    message_id = history.append_messages('a', {'role': 'assistant', 'content': ''})
+
+    seen = []
+
+    def listener(instance, op, args, removed):
+        # 和搜索索引一样在通知时读取消息
+        seen.append((op, instance.get_messages(args[0])[args[1]]['content']))
+    history.add_listener(listener)
+
+    history.append_message_content_by_id('a', message_id, 'streamed')
+    assert contents(history, 'b') == ['b']
+    assert seen == [('append_content', 'streamed')]
+
+    history = reopen(open_storage, history, 'sqlite')
+    assert contents(history, 'a') == ['a', 'streamed']
+
+
+def test_sqlite_insert_between_rows_renumbers_when_needed(open_storage, monkeypatch):
+    monkeypatch.setattr(storage.ChatHistorySQLiteStorage, 'position_gap', 2)
+    history = open_storage('sqlite')
+    history.set_common_config('chat', {})
+    for index in range(3):
+        history.append_messages('chat', {'role': 'user', 'content': str(index)})
+    history._execute('insert', 'chat', 1, {'role': 'user', 'content': 'x', 'id': 'x'})
+    history._execute('insert', 'chat', 1, {'role': 'user', 'content': 'y', 'id': 'y'})
+
+    history = reopen(open_storage, history, 'sqlite')
+    assert contents(history, 'chat') == ['0', 'y', 'x', '1', '2']
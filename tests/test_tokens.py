@@ -0,0 +1,70 @@
+import sys
+
+import pytest
+
+from anywhere.tokens import TokenCounter, trim_messages
+
+
+@pytest.fixture
+def counter(monkeypatch):
+    # 没有安装 tiktoken 时按字符估算，测试中固定使用估算的结果
+    monkeypatch.setitem(sys.modules, 'tiktoken', None)
+    return TokenCounter()
+
+
+def conversation():
+    messages = [{'role': 'system', 'content': 'system'}]
+    for index in range(4):
+        messages.append({'role': 'user', 'content': 'question {} '.format(index) * 10})
+        messages.append({'role': 'assistant', 'content': 'answer {} '.format(index) * 10})
+    messages.append({'role': 'user', 'content': 'last question'})
+    return messages
+
+
+def test_counts_without_tiktoken(counter):
+    assert counter.count_text('你好') == 2
+    assert counter.count_text('abcdefgh') == 2
+    assert counter.count_text('你好abcd') == 3
+    assert counter.count_message({'role': 'user', 'content': '你好'}) == 6
+    assert counter.count_messages([]) == 0
+    assert counter._encoding is False
+
+
+def test_all_policy_keeps_everything(counter):
+    messages = conversation()
+    assert trim_messages(messages, 'all', 10, counter=counter) is messages
+
+
+def test_window_keeps_whole_turns(counter):
+    messages = conversation()
+    turn = sum(counter.count_message(m) for m in messages[1:3])
+    system = counter.count_messages(messages[:1])
+    last = counter.count_message(messages[-1])
+
+    # 预算只比最后一轮多出半轮，前一轮整个丢弃，不会只留下它的回复
+    trimmed = trim_messages(messages, 'window', system + last + turn // 2, counter=counter)
+    assert trimmed == [messages[0], messages[-1]]
+
+    trimmed = trim_messages(messages, 'window', system + last + turn * 2, counter=counter)
+    assert trimmed == [messages[0]] + messages[-5:]
+    assert trimmed[1]['role'] == 'user'
+
+
+def test_window_always_keeps_latest_turn(counter):
+    messages = conversation()
+    assert trim_messages(messages, 'window', 1, counter=counter) == [messages[0], messages[-1]]
+    assert trim_messages(messages, 'window', 1, keep_system=False, counter=counter) == [
+        messages[-1]]
+
+
+def test_summary_replaces_dropped_turns(counter):
+    messages = conversation()
+    trimmed = trim_messages(messages, 'summary', 160, counter=counter)
+
+    assert trimmed[0] == messages[0]
+    assert trimmed[1]['role'] == 'system'
+    assert trimmed[1]['content'].startswith('以下是之前对话的摘要')
+    assert '用户：question 0' in trimmed[1]['content']
+    kept = trimmed[2:]
+    assert kept == messages[len(messages) - len(kept):]
+    assert len(kept) == 3 and kept[0]['role'] == 'user'